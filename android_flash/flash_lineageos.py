@@ -1,19 +1,45 @@
 import os
 import re
+import json
 import time
 import toml
+import queue
+import argparse
+import hashlib
 import logging
 import requests
+import threading
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from bs4 import BeautifulSoup
 
 logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
 
+EXCLUDED_FILES = {"vbmeta.img", "super_empty.img"}
+STORE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "flash_lineageos")
+STORE_MAX_BYTES = 8 * 1024 * 1024 * 1024
+HASH_CACHE_FILE = ".sha256cache.json"
+HASH_BUFFER_SIZE = 8 * 1024 * 1024
+HASH_WORKERS = min(4, os.cpu_count() or 1)
+ADB = "adb"
+FASTBOOT = "fastboot"
+DEVICE_TIMEOUT = 600
+LOG_DIR = "logs"
+METADATA_TTL = 6 * 60 * 60
+METADATA_WORKERS = 8
+
 
 def run(command):
     return os.system(command)
 
 
+def check_command(*args):
+    """Runs a command without a shell, raising if it exits with a nonzero code."""
+    returncode = subprocess.run(args).returncode
+    if returncode != 0:
+        raise Exception(f"{' '.join(args)} exited with code {returncode}")
+
+
 def aria2c_download(urls, directory):
     if run(f"aria2c -c -s 8 -x 8 -k 1M -j 1 -Z --dir {directory} {urls}") == 0:
         logging.info(f"Downloaded {urls} successfully")
@@ -21,11 +47,6 @@ def aria2c_download(urls, directory):
         raise Exception(f"Failed to download {urls}")
 
 
-def read_config(section, key, filename="config.toml"):
-    with open(filename, "r") as f:
-        return toml.load(f)[section][key]
-
-
 def save_config(section, key, value, filename="config.toml"):
     config = {}
     if os.path.exists(filename):
@@ -36,102 +57,656 @@ def save_config(section, key, value, filename="config.toml"):
         toml.dump(config, f)
 
 
-def lineage_download(device_code):
-    res = requests.get(
-        f"https://download.lineageos.org/api/v2/devices/{device_code}/builds"
-    ).json()[0]
-    remote_timestamp = res["datetime"]
+def file_sha256(path):
+    # hashlib 在处理大块数据时会释放 GIL，多个线程可以真正并行计算
+    h = hashlib.sha256()
+    buffer = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as f:
+        while n := f.readinto(buffer):
+            h.update(view[:n])
+    return h.hexdigest()
 
-    try:
-        local_timestamp = int(read_config("data", "timestamp"))
-        if local_timestamp >= remote_timestamp:
-            raise Exception(f"LineageOS for {device_code} hasn't been updated yet")
-    except FileNotFoundError:
-        logging.info("config.toml not found, creating a new one")
-    save_config("data", "timestamp", remote_timestamp)
 
-    urls = " ".join(
-        file["url"]
-        for file in res["files"]
-        if file["filename"] not in {"vbmeta.img", "super_empty.img"}
-    )
-    sha256 = {
-        file["filename"]: file["sha256"]
-        for file in res["files"]
-        if file["filename"] not in {"vbmeta.img", "super_empty.img"}
-    }
+def load_hash_cache(directory):
+    try:
+        with open(os.path.join(directory, HASH_CACHE_FILE), "r") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
 
-    aria2c_download(urls, "tmp")
-    logging.info(sha256)
 
+def save_hash_cache(directory, cache):
+    with open(os.path.join(directory, HASH_CACHE_FILE), "w") as f:
+        json.dump(cache, f, indent=2)
 
-def wait_until_string_appears(command, target_string, interval=1):
-    while True:
-        result = subprocess.run(command, text=True, capture_output=True)
-        if target_string in result.stdout:
-            logging.debug("Target string appeared")
-            break
-        time.sleep(interval)
 
+def cached_sha256(directory, filename, cache):
+    """Hashes a file unless the cache already has it at the same size and mtime."""
+    st = os.stat(os.path.join(directory, filename))
+    entry = cache.get(filename)
+    if entry and entry["size"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns:
+        return entry["sha256"]
+    digest = file_sha256(os.path.join(directory, filename))
+    cache[filename] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": digest}
+    return digest
 
-def clear_tmp():
-    for root, dirs, files in os.walk("tmp/", topdown=False):
-        for name in files:
-            os.remove(os.path.join(root, name))
-        for name in dirs:
-            os.rmdir(os.path.join(root, name))
-    os.rmdir("tmp/")
 
+def parse_sha256sum(text):
+    """Parses `sha256sum` output, the format of microG's .sha256sum files."""
+    checksums = {}
+    for line in text.splitlines():
+        parts = line.strip().split(maxsplit=1)
+        if len(parts) == 2:
+            checksums[os.path.basename(parts[1].lstrip("*"))] = parts[0].lower()
+    return checksums
 
-def lineage_flash():
-    files = os.listdir("tmp")
-    boot = next((f for f in files if "boot.img" in f), None)
-    recovery = next((f for f in files if "recovery.img" in f), None)
-    lineage_zip = next(
-        (f for f in files if "lineage-" in f and f.endswith(".zip")), None
-    )
 
-    if not boot or not recovery:
-        raise FileNotFoundError("Required image files not found in tmp/")
+def write_checksums(path, sha256):
+    with open(path, "w") as f:
+        for filename, digest in sorted(sha256.items()):
+            f.write(f"{digest}  {filename}\n")
 
-    logging.info("Boot into fastboot mode now")
-    wait_until_string_appears(["fastboot", "devices"], "fastboot")
-    run(f"fastboot flash boot tmp/{boot}")
-    run(f"fastboot flash recovery tmp/{recovery}")
 
-    logging.info("Reboot to recovery mode and open adb sideload")
-    wait_until_string_appears(["adb", "devices"], "\tsideload")
-    run(f"adb sideload tmp/{lineage_zip}")
+def read_checksums(path):
+    try:
+        with open(path, "r") as f:
+            return parse_sha256sum(f.read())
+    except FileNotFoundError:
+        return {}
+
+
+def verify_files(directory, sha256, workers=HASH_WORKERS):
+    """Returns the files that are missing or don't match their expected sha256."""
+    cache = load_hash_cache(directory)
+
+    def check(filename):
+        if not os.path.isfile(os.path.join(directory, filename)):
+            return filename
+        return None if cached_sha256(directory, filename, cache) == sha256[filename] else filename
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        bad = [f for f in pool.map(check, sha256) if f]
+    save_hash_cache(directory, cache)
+    return bad
+
+
+def download_and_verify(urls, sha256, directory):
+    """
+    Downloads files one after another and hashes each one in the background as
+    soon as it completes, so hashing overlaps with the next download. Files that
+    fail verification are deleted and reported.
+    """
+    os.makedirs(directory, exist_ok=True)
+    cache = load_hash_cache(directory)
+    futures = {}
+    with ThreadPoolExecutor(max_workers=HASH_WORKERS) as pool:
+        for filename, url in urls.items():
+            aria2c_download(url, directory)
+            futures[filename] = pool.submit(cached_sha256, directory, filename, cache)
+    save_hash_cache(directory, cache)
+
+    bad = [f for f, future in futures.items() if future.result() != sha256.get(f)]
+    for filename in bad:
+        logging.error(f"{filename}: sha256 mismatch, expected {sha256.get(filename)}")
+        os.remove(os.path.join(directory, filename))
+    if bad:
+        raise Exception(f"Checksum verification failed for {', '.join(bad)}")
+    logging.info(f"Verified {len(futures)} files")
+
+
+class BuildStore:
+    """
+    A content-addressed store of build files, keyed by their sha256.
+
+    Files are verified before they enter the store, and the files of a build that
+    is already stored are never downloaded again. The store also remembers the
+    latest build of each device as a sha256sum file, so flashing reads straight
+    from it. Once the store grows past max_bytes, the least recently used files
+    are evicted.
+    """
+
+    def __init__(self, root=STORE_DIR, max_bytes=STORE_MAX_BYTES):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.objects = os.path.join(root, "objects")
+        self.incoming = os.path.join(root, "incoming")
+        self.builds = os.path.join(root, "builds")
+        for directory in (self.objects, self.incoming, self.builds):
+            os.makedirs(directory, exist_ok=True)
+        self.index_path = os.path.join(root, "index.json")
+        try:
+            with open(self.index_path, "r") as f:
+                self.index = json.load(f)
+        except FileNotFoundError:
+            self.index = {}
+
+    def save(self):
+        with open(self.index_path + ".tmp", "w") as f:
+            json.dump(self.index, f, indent=2)
+        os.replace(self.index_path + ".tmp", self.index_path)
+
+    def path(self, digest):
+        return os.path.join(self.objects, digest)
+
+    def has(self, digest):
+        entry = self.index.get(digest)
+        return (
+            entry is not None
+            and os.path.isfile(self.path(digest))
+            and os.path.getsize(self.path(digest)) == entry["size"]
+        )
 
-    clear_tmp()
+    def touch(self, digests):
+        now = time.time()
+        for digest in digests:
+            if digest in self.index:
+                self.index[digest]["last_used"] = now
+        self.save()
+
+    def put(self, filename, digest):
+        """Moves a verified file from incoming/ into the store."""
+        st = os.stat(os.path.join(self.incoming, filename))
+        os.replace(os.path.join(self.incoming, filename), self.path(digest))
+        self.index[digest] = {"filename": filename, "size": st.st_size, "last_used": time.time()}
+        # 文件刚校验过，直接写入哈希缓存，刷机前的校验就不必重新计算
+        cache = load_hash_cache(self.objects)
+        cache[digest] = {"size": st.st_size, "mtime_ns": st.st_mtime_ns, "sha256": digest}
+        save_hash_cache(self.objects, cache)
+
+    def fetch(self, urls, sha256):
+        """Downloads whatever files of a build the store doesn't have yet."""
+        missing = {f: url for f, url in urls.items() if not self.has(sha256[f])}
+        if missing:
+            download_and_verify(missing, {f: sha256[f] for f in missing}, self.incoming)
+            for filename in missing:
+                self.put(filename, sha256[filename])
+        logging.info(f"{len(urls) - len(missing)} of {len(urls)} files already in the store")
+        self.touch(sha256.values())
+        self.evict(keep=set(sha256.values()))
+
+    def evict(self, keep=()):
+        total = sum(entry["size"] for entry in self.index.values())
+        cache = load_hash_cache(self.objects)
+        for digest, entry in sorted(self.index.items(), key=lambda item: item[1]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            if digest in keep:
+                continue
+            if os.path.exists(self.path(digest)):
+                os.remove(self.path(digest))
+            total -= entry["size"]
+            del self.index[digest]
+            cache.pop(digest, None)
+            logging.info(f"Evicted {entry['filename']} from the store")
+        save_hash_cache(self.objects, cache)
+        self.save()
+
+    def save_build(self, device_code, sha256):
+        write_checksums(os.path.join(self.builds, f"{device_code}.sha256sum"), sha256)
+
+    def load_build(self, device_code):
+        return read_checksums(os.path.join(self.builds, f"{device_code}.sha256sum"))
+
+
+def fetch_lineage_build(device_code):
+    res = requests.get(
+        f"https://download.lineageos.org/api/v2/devices/{device_code}/builds", timeout=30
+    ).json()[0]
+    return {
+        "datetime": res["datetime"],
+        "files": [
+            {"filename": f["filename"], "url": f["url"], "sha256": f["sha256"], "size": f.get("size")}
+            for f in res["files"]
+            if f["filename"] not in EXCLUDED_FILES
+        ],
+    }
 
 
-def lineage_with_microG_download(device_code):
-    html = requests.get(f"https://download.lineage.microg.org/{device_code}/").text
+def fetch_microg_build(device_code):
+    base_url = f"https://download.lineage.microg.org/{device_code}/"
+    session = requests.Session()
+    html = session.get(base_url, timeout=30).text
     soup = BeautifulSoup(html, "html.parser")
 
     links = [a["href"] for a in soup.select("td > a")]
     dates = {match.group() for link in links if (match := re.search(r"\d{8}", link))}
 
     if not dates:
-        logging.error("No valid dates found in links")
-        return
+        raise Exception(f"No valid dates found in links for {device_code}")
 
     latest_date = max(dates)
-    download_urls = [
-        f"https://download.lineage.microg.org/{device_code}/{link[2:]}"
-        for link in links
-        if latest_date in link
-        and all(
-            excl not in link for excl in {".sha256sum", "super_empty.img", "vbmeta.img"}
-        )
-    ]
+    latest = [link[2:] for link in links if latest_date in link]
+    download_urls = {
+        os.path.basename(link): base_url + link
+        for link in latest
+        if all(excl not in link for excl in {".sha256sum", *EXCLUDED_FILES})
+    }
 
-    aria2c_download(" ".join(download_urls), "tmp")
+    sha256 = {}
+    for link in latest:
+        if link.endswith(".sha256sum"):
+            sha256.update(parse_sha256sum(session.get(base_url + link, timeout=30).text))
+    missing = [f for f in download_urls if f not in sha256]
+    if missing:
+        raise Exception(f"No .sha256sum published for {', '.join(missing)}")
+
+    files = []
+    for filename, url in download_urls.items():
+        # 索引页没有文件大小，用 HEAD 请求获取，结果会和其他元数据一起缓存
+        length = session.head(url, allow_redirects=True, timeout=30).headers.get("Content-Length")
+        files.append({
+            "filename": filename,
+            "url": url,
+            "sha256": sha256[filename],
+            "size": int(length) if length else None,
+        })
+    return {"datetime": int(latest_date), "files": files}
+
+
+BUILD_SOURCES = {"lineage": fetch_lineage_build, "microg": fetch_microg_build}
+
+
+class MetadataCache:
+    """
+    Latest build metadata per source and device codename, kept in the store as
+    metadata.json. Entries younger than the TTL are used without touching the
+    network; stale entries for several codenames are refreshed concurrently.
+    """
+
+    def __init__(self, root=STORE_DIR, ttl=METADATA_TTL):
+        self.ttl = ttl
+        self.path = os.path.join(root, "metadata.json")
+        os.makedirs(root, exist_ok=True)
+        try:
+            with open(self.path, "r") as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            self.entries = {}
+
+    def save(self):
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(self.entries, f, indent=2)
+        os.replace(self.path + ".tmp", self.path)
+
+    def age(self, device_code, source="lineage"):
+        entry = self.entries.get(f"{source}:{device_code}")
+        return time.time() - entry["fetched_at"] if entry else None
+
+    def get(self, device_codes, source="lineage", refresh=False, max_age=None):
+        """Returns {codename: build}, leaving out codenames that couldn't be fetched."""
+        max_age = self.ttl if max_age is None else max_age
+        stale = [
+            c for c in device_codes
+            if refresh or self.age(c, source) is None or self.age(c, source) > max_age
+        ]
+        if stale:
+            with ThreadPoolExecutor(max_workers=min(METADATA_WORKERS, len(stale))) as pool:
+                futures = {c: pool.submit(BUILD_SOURCES[source], c) for c in stale}
+            now = time.time()
+            for device_code, future in futures.items():
+                try:
+                    build = future.result()
+                except Exception as e:
+                    logging.error(f"Failed to fetch {source} metadata for {device_code}: {e}")
+                    continue
+                self.entries[f"{source}:{device_code}"] = {"fetched_at": now, "build": build}
+            self.save()
+        return {
+            c: self.entries[f"{source}:{c}"]["build"]
+            for c in device_codes
+            if f"{source}:{c}" in self.entries
+        }
+
+
+def download_build(device_code, build, source="lineage", store=None):
+    # 构建没有更新时 store.fetch 不会重新下载任何文件，无需单独比较时间戳
+    urls = {file["filename"]: file["url"] for file in build["files"]}
+    sha256 = {file["filename"]: file["sha256"] for file in build["files"]}
+
+    store = store or BuildStore()
+    store.fetch(urls, sha256)
+    store.save_build(device_code, sha256)
+    # 文件下载并校验通过后才记录时间戳
+    save_config(device_code, source, build["datetime"])
+
+
+def download_builds(device_codes, source="lineage", refresh=False, store=None):
+    """Refreshes metadata for all codenames at once, then downloads each build."""
+    store = store or BuildStore()
+    builds = MetadataCache(store.root).get(device_codes, source, refresh=refresh)
+    failed = [c for c in device_codes if c not in builds]
+    for device_code, build in builds.items():
+        try:
+            download_build(device_code, build, source, store)
+        except Exception as e:
+            logging.error(f"Failed to download {source} build for {device_code}: {e}")
+            failed.append(device_code)
+    if failed:
+        raise Exception(f"Failed to download builds for {', '.join(failed)}")
+
+
+def lineage_download(device_code, store=None):
+    download_builds([device_code], "lineage", store=store)
+
+
+def format_size(size):
+    return "?" if size is None else f"{size / 1024 / 1024:.1f} MiB"
+
+
+def plan(device_codes, source="lineage", refresh=False, store=None):
+    """Shows which files a download would fetch, using cached metadata when present."""
+    store = store or BuildStore()
+    cache = MetadataCache(store.root)
+    builds = cache.get(device_codes, source, refresh=refresh, max_age=float("inf"))
+    for device_code in device_codes:
+        build = builds.get(device_code)
+        if build is None:
+            print(f"{device_code}: no {source} metadata")
+            continue
+        age = cache.age(device_code, source)
+        print(f"{device_code}: {source} build {build['datetime']} (metadata {age / 3600:.1f} h old)")
+        to_fetch = 0
+        for file in build["files"]:
+            cached = store.has(file["sha256"])
+            if not cached:
+                to_fetch += file["size"] or 0
+            print(f"  {'cached' if cached else 'fetch':<6}  {format_size(file['size']):>12}  {file['filename']}")
+        total = sum(file["size"] or 0 for file in build["files"])
+        print(f"  {format_size(to_fetch)} to fetch of {format_size(total)}")
+
+
+def parse_device_list(text):
+    """Parses `adb devices`/`fastboot devices` output into {serial: state}."""
+    devices = {}
+    for line in text.splitlines():
+        parts = line.split("\t")
+        if len(parts) >= 2:
+            devices[parts[0].strip()] = parts[1].split()[0] if parts[1].strip() else ""
+    return devices
+
+
+def find_device(devices, state, serial=None):
+    for device_serial, device_state in devices.items():
+        if device_state == state and serial in (None, device_serial):
+            return device_serial
+    return None
+
+
+def poll_devices(command, state, serial, deadline, min_interval=0.1, max_interval=1.0):
+    """
+    Polls a `devices` command until a device reaches the state. The interval starts
+    short and grows while nothing changes, so a device that is already there is seen
+    at once without spawning a process every 100 ms for minutes.
+    """
+    interval = min_interval
+    while True:
+        result = subprocess.run(command, text=True, capture_output=True)
+        match = find_device(parse_device_list(result.stdout), state, serial)
+        if match:
+            return match
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"No device in {state} state after waiting")
+        time.sleep(min(interval, remaining))
+        interval = min(interval * 1.5, max_interval)
+
+
+def _read_track_devices(process, snapshots):
+    # track-devices 每次状态变化输出一帧：4 位十六进制长度 + 设备列表
+    stream = process.stdout
+    while len(header := stream.read(4)) == 4:
+        length = int(header, 16)
+        snapshots.put(parse_device_list(stream.read(length) if length else ""))
+    snapshots.put(None)
+
+
+def wait_for_adb(state, serial=None, timeout=DEVICE_TIMEOUT):
+    """
+    Waits until an adb device reaches the state (e.g. "device" or "sideload") and
+    returns its serial. Uses one long-lived `adb track-devices` stream and falls
+    back to polling `adb devices` if the stream ends.
+    """
+    deadline = time.monotonic() + timeout
+    process = subprocess.Popen(
+        [ADB, "track-devices"], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True
+    )
+    snapshots = queue.Queue()
+    threading.Thread(target=_read_track_devices, args=(process, snapshots), daemon=True).start()
+    try:
+        while True:
+            try:
+                devices = snapshots.get(timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                raise TimeoutError(f"No adb device in {state} state after {timeout} s")
+            if devices is None:
+                logging.debug("adb track-devices ended, falling back to polling")
+                return poll_devices([ADB, "devices"], state, serial, deadline)
+            match = find_device(devices, state, serial)
+            if match:
+                return match
+    finally:
+        process.kill()
+        process.wait()
+
+
+def wait_for_fastboot(serial=None, timeout=DEVICE_TIMEOUT):
+    """Waits until a device shows up in fastboot mode and returns its serial."""
+    # fastboot 没有类似 track-devices 的流式接口，只能轮询
+    deadline = time.monotonic() + timeout
+    return poll_devices([FASTBOOT, "devices"], "fastboot", serial, deadline)
+
+
+def build_images(device_code, store):
+    """Verifies a stored build and returns the paths of its boot, recovery and zip."""
+    sha256 = store.load_build(device_code)
+    boot = next((f for f in sha256 if "boot.img" in f), None)
+    recovery = next((f for f in sha256 if "recovery.img" in f), None)
+    lineage_zip = next(
+        (f for f in sha256 if "lineage-" in f and f.endswith(".zip")), None
+    )
 
+    if not boot or not recovery or not lineage_zip:
+        raise FileNotFoundError(f"No complete build for {device_code} in {store.root}")
+
+    names = {sha256[f]: f for f in (boot, recovery, lineage_zip)}
+    digests = list(names)
+    bad = verify_files(store.objects, {d: d for d in digests})
+    if bad:
+        raise Exception(f"Checksum mismatch for {', '.join(names[d] for d in bad)}, refusing to flash")
+    store.touch(digests)
+    return {
+        "boot": store.path(sha256[boot]),
+        "recovery": store.path(sha256[recovery]),
+        "zip": store.path(sha256[lineage_zip]),
+    }
 
-if __name__ == "__main__":
-    lineage_download("polaris")
-    # lineage_with_microG_download("polaris")
-    lineage_flash()
+
+def lineage_flash(device_code, store=None):
+    images = build_images(device_code, store or BuildStore())
+
+    logging.info("Boot into fastboot mode now")
+    wait_for_fastboot()
+    check_command(FASTBOOT, "flash", "boot", images["boot"])
+    check_command(FASTBOOT, "flash", "recovery", images["recovery"])
+
+    logging.info("Reboot to recovery mode and open adb sideload")
+    wait_for_adb("sideload")
+    check_command(ADB, "sideload", images["zip"])
+
+
+def list_devices():
+    """Returns {serial: state} for every device attached over adb or fastboot."""
+    devices = parse_device_list(subprocess.run([ADB, "devices"], text=True, capture_output=True).stdout)
+    devices.update(
+        parse_device_list(subprocess.run([FASTBOOT, "devices"], text=True, capture_output=True).stdout)
+    )
+    return devices
+
+
+def device_codename(serial, state):
+    if state == "fastboot":
+        result = subprocess.run(
+            [FASTBOOT, "-s", serial, "getvar", "product"], text=True, capture_output=True
+        )
+        # fastboot getvar 把结果写到 stderr
+        match = re.search(r"product:\s*(\S+)", result.stderr + result.stdout)
+        return match.group(1) if match else None
+    if state in ("device", "recovery"):
+        result = subprocess.run(
+            [ADB, "-s", serial, "shell", "getprop", "ro.product.device"],
+            text=True,
+            capture_output=True,
+        )
+        return result.stdout.strip() or None
+    return None
+
+
+class DeviceFlash:
+    """
+    Flashes one device identified by its serial, stepping through
+    bootloader -> boot -> recovery -> sideload. Every adb/fastboot call passes
+    -s, command output goes to logs/<serial>.log, and each step is timed.
+    """
+
+    def __init__(self, serial, state, codename, images):
+        self.serial = serial
+        self.initial_state = state
+        self.codename = codename
+        self.images = images
+        self.state = "pending"
+        self.error = None
+        self.timings = {}
+        self.log = logging.getLogger(f"flash.{serial}")
+        os.makedirs(LOG_DIR, exist_ok=True)
+        self.log_path = os.path.join(LOG_DIR, f"{serial}.log")
+        file_handler = logging.FileHandler(self.log_path)
+        file_handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(message)s"))
+        # 命令输出只写入设备日志，终端上只显示进度
+        console = logging.StreamHandler()
+        console.setLevel(logging.INFO)
+        console.setFormatter(logging.Formatter("[%(levelname)s] %(message)s"))
+        self.log.handlers = [file_handler, console]
+        self.log.setLevel(logging.DEBUG)
+        self.log.propagate = False
+
+    def command(self, *args):
+        result = subprocess.run(args, text=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        self.log.debug(f"$ {' '.join(args)}\n{result.stdout}")
+        if result.returncode != 0:
+            raise Exception(f"{' '.join(args)} exited with code {result.returncode}")
+
+    def step(self, name, func):
+        self.state = name
+        self.log.info(f"[{self.serial}] {name}")
+        start = time.perf_counter()
+        func()
+        self.timings[name] = time.perf_counter() - start
+
+    def enter_bootloader(self):
+        if self.initial_state != "fastboot":
+            self.command(ADB, "-s", self.serial, "reboot", "bootloader")
+        wait_for_fastboot(self.serial)
+
+    def flash_images(self):
+        self.command(FASTBOOT, "-s", self.serial, "flash", "boot", self.images["boot"])
+        self.command(FASTBOOT, "-s", self.serial, "flash", "recovery", self.images["recovery"])
+
+    def enter_sideload(self):
+        self.command(FASTBOOT, "-s", self.serial, "reboot", "recovery")
+        self.log.info(f"[{self.serial}] Open Apply update -> Apply from ADB in recovery")
+        wait_for_adb("sideload", self.serial)
+
+    def sideload(self):
+        self.command(ADB, "-s", self.serial, "sideload", self.images["zip"])
+
+    def run(self):
+        start = time.perf_counter()
+        try:
+            self.step("bootloader", self.enter_bootloader)
+            self.step("flash", self.flash_images)
+            self.step("recovery", self.enter_sideload)
+            self.step("sideload", self.sideload)
+            self.state = "done"
+        except Exception as e:
+            # 单台设备失败只记录下来，不影响其他设备
+            self.error = e
+            self.log.error(f"[{self.serial}] failed during {self.state}: {e}")
+            self.log.debug("Traceback", exc_info=True)
+            self.state = f"failed ({self.state})"
+        self.timings["total"] = time.perf_counter() - start
+        return self
+
+
+def flash_all(store=None):
+    """Flashes every attached device concurrently with its own cached build."""
+    store = store or BuildStore()
+    devices = list_devices()
+    if not devices:
+        logging.error("No devices attached")
+        return []
+
+    jobs = []
+    images = {}
+    for serial, state in devices.items():
+        codename = device_codename(serial, state)
+        if not codename:
+            logging.error(f"[{serial}] can't read the codename in {state} state, skipping")
+            continue
+        if codename not in images:
+            try:
+                images[codename] = build_images(codename, store)
+            except Exception as e:
+                logging.error(f"[{serial}] {e}")
+                images[codename] = None
+        if images[codename] is None:
+            continue
+        logging.info(f"[{serial}] {codename}, currently in {state} mode")
+        jobs.append(DeviceFlash(serial, state, codename, images[codename]))
+
+    with ThreadPoolExecutor(max_workers=max(1, len(jobs))) as pool:
+        results = list(pool.map(DeviceFlash.run, jobs))
+
+    for job in results:
+        steps = ", ".join(f"{k} {v:.1f}s" for k, v in job.timings.items())
+        level = logging.INFO if job.state == "done" else logging.ERROR
+        logging.log(level, f"[{job.serial}] {job.codename}: {job.state} ({steps}), log: {job.log_path}")
+    return results
+
+
+def lineage_with_microG_download(device_code, store=None):
+    download_builds([device_code], "microg", store=store)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Download and flash LineageOS builds.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    for name, description in (
+        ("download", "Download the latest builds into the store."),
+        ("plan", "Show which files a download would fetch, from cached metadata."),
+    ):
+        command = commands.add_parser(name, help=description)
+        command.add_argument("device_codes", nargs="+", help="Device codenames, e.g. polaris.")
+        command.add_argument("--microg", action="store_true", help="Use LineageOS for microG.")
+        command.add_argument("--refresh", action="store_true", help="Ignore the metadata TTL.")
+    flash = commands.add_parser("flash", help="Flash the single attached device.")
+    flash.add_argument("device_code")
+    commands.add_parser("flash-all", help="Flash every attached device concurrently.")
+    args = parser.parse_args()
+
+    if args.command == "download":
+        download_builds(args.device_codes, "microg" if args.microg else "lineage", args.refresh)
+    elif args.command == "plan":
+        plan(args.device_codes, "microg" if args.microg else "lineage", args.refresh)
+        return
+    elif args.command == "flash":
+        lineage_flash(args.device_code)
+    else:
+        results = flash_all()
+        if not results or any(job.state != "done" for job in results):
+            raise SystemExit(1)
     logging.info("Done.")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,55 +1,374 @@
-import os
+import json
+import time
+import uuid
+import socket
+import hashlib
+import subprocess
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from urllib.parse import urljoin
 from bs4 import BeautifulSoup
 import requests
+from requests.adapters import HTTPAdapter
 import logging
+from typing import Optional
 from typing_extensions import Annotated
 import typer
 
 
 logging.basicConfig(level=logging.INFO, format="[%(levelname)s] %(message)s")
 
+DEFAULT_CACHE_DIR = Path.home() / ".cache" / "github_star_list_downloader"
+API_URL = "https://api.github.com"
+MANIFEST_NAME = ".manifest.json"
 
-def run(command):
-    return os.system(command)
 
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
 
-def aria2c_download(urls, directory):
-    if run(f"aria2c -c -s 8 -x 8 -k 1M -j 1 -Z --dir {directory} {urls}") == 0:
-        print(f"Downloaded {urls} successfully")
-    else:
-        raise Exception(f"Failed to download {urls}")
+
+class Aria2Downloader:
+    """
+    Feeds URLs to a single aria2c process through its JSON-RPC interface.
+
+    aria2c is started on the first add(), so a run with nothing to download never
+    launches it. Downloads begin as soon as they are added and run with at most
+    `concurrency` files at a time.
+    """
+
+    def __init__(self, directory, concurrency=4, aria2c="aria2c"):
+        self.directory = str(directory)
+        self.concurrency = concurrency
+        self.aria2c = aria2c
+        self.process = None
+        self.gids = {}
+        self.session = requests.Session()
+        self.secret = uuid.uuid4().hex
+        self.rpc_url = None
+
+    def call(self, method, *params):
+        payload = {
+            "jsonrpc": "2.0",
+            "id": method,
+            "method": f"aria2.{method}",
+            "params": [f"token:{self.secret}", *params],
+        }
+        response = self.session.post(self.rpc_url, json=payload, timeout=30)
+        result = response.json()
+        if "error" in result:
+            raise Exception(f"aria2 {method} failed: {result['error']['message']}")
+        return result["result"]
+
+    def start(self):
+        port = free_port()
+        self.rpc_url = f"http://127.0.0.1:{port}/jsonrpc"
+        self.process = subprocess.Popen([
+            self.aria2c, "--enable-rpc", f"--rpc-listen-port={port}",
+            f"--rpc-secret={self.secret}", f"--dir={self.directory}",
+            f"--max-concurrent-downloads={self.concurrency}",
+            "-c", "-s", "8", "-x", "8", "-k", "1M",
+        ], stdout=subprocess.DEVNULL)
+        for _ in range(100):
+            if self.process.poll() is not None:
+                raise Exception(f"aria2c exited with code {self.process.returncode}")
+            try:
+                self.call("getVersion")
+                return
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        raise Exception("aria2c RPC did not come up")
+
+    def add(self, url, options=None):
+        if self.process is None:
+            self.start()
+        gid = self.call("addUri", [url], options or {})
+        self.gids[gid] = url
+        logging.info(f"Queued {url}")
+        return gid
+
+    def wait(self, interval=1.0):
+        """Blocks until every queued download has finished; returns the failed URLs."""
+        pending = dict(self.gids)
+        failed = []
+        while pending:
+            for gid, url in list(pending.items()):
+                status = self.call("tellStatus", gid, ["status", "errorMessage"])
+                if status["status"] == "complete":
+                    print(f"Downloaded {url} successfully")
+                elif status["status"] in ("error", "removed"):
+                    logging.error(f"Failed to download {url}: {status.get('errorMessage', '')}")
+                    failed.append(url)
+                else:
+                    continue
+                del pending[gid]
+            if pending:
+                time.sleep(interval)
+        return failed
+
+    def close(self):
+        if self.process is None:
+            return
+        try:
+            self.call("shutdown")
+        except Exception:
+            self.process.terminate()
+        self.process.wait()
+        self.process = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class CachedClient:
+    """
+    A keep-alive HTTP client that revalidates responses with ETags.
+
+    Every JSON response is stored on disk together with its ETag. Later requests
+    send If-None-Match, and a 304 answer is served from the cache; with a token,
+    GitHub does not count such requests against the rate limit.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, token=None, pool_size=10):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.session.headers["Accept"] = "application/vnd.github+json"
+        if token:
+            self.session.headers["Authorization"] = f"Bearer {token}"
+
+    def _cache_path(self, url):
+        return self.cache_dir / f"{hashlib.sha256(url.encode()).hexdigest()}.json"
+
+    def get_json(self, url):
+        """Returns (body, status) where status is "cached" for a 304 answer."""
+        path = self._cache_path(url)
+        cached = None
+        if path.exists():
+            try:
+                cached = json.loads(path.read_text(encoding="utf-8"))
+            except (OSError, ValueError):
+                cached = None
+
+        headers = {}
+        if cached and cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        response = self.session.get(url, headers=headers, timeout=30)
+        if response.status_code == 304 and cached:
+            return cached["body"], "cached"
+        response.raise_for_status()
+
+        body = response.json()
+        etag = response.headers.get("ETag")
+        if etag:
+            tmp = path.with_suffix(".tmp")
+            tmp.write_text(json.dumps({"etag": etag, "body": body}), encoding="utf-8")
+            tmp.replace(path)
+        return body, str(response.status_code)
+
+
+def file_sha256(path, chunk_size=1024 * 1024):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(chunk_size):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def asset_path(repo, name):
+    """
+    Where a repo's file lives, relative to the download directory. Each repo gets an
+    "owner__name" subdirectory, because unrelated repos often ship the same asset
+    name (app-release.apk, ...) and would otherwise overwrite each other.
+    """
+    return Path(repo.replace("/", "__")) / name
 
 
-def parse_star_list(url):
-    html = requests.get(url).text
-    soup = BeautifulSoup(html, "html.parser")
-    href = soup.select("#user-list-repositories .d-inline-block a")
-    links = []
-    for i in href:
-        links.append(f"https://api.github.com/repos{i['href']}/releases")
-    return links
+class Manifest:
+    """
+    Records which release asset has been downloaded for each repo.
 
+    The manifest is a JSON file in the download directory mapping
+    "owner/name" to the release tag, asset name, size and sha256 digest.
+    """
 
-def parse_releases_api(url):
-    latest_res = requests.get(url).json()[0]["assets"]
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.path = self.directory / MANIFEST_NAME
+        self.entries = {}
+        if self.path.exists():
+            self.entries = json.loads(self.path.read_text(encoding="utf-8"))
+
+    def is_current(self, record):
+        """True if the repo's latest asset is already on disk with the recorded size."""
+        entry = self.entries.get(record["repo"])
+        if not entry or entry["tag"] != record["tag"] or entry["asset"] != record["asset"]:
+            return False
+        path = self.directory / asset_path(record["repo"], entry["asset"])
+        return path.is_file() and path.stat().st_size == entry["size"]
+
+    def update(self, record, digest):
+        """Stores a downloaded asset and returns the entry it replaces, if any."""
+        previous = self.entries.get(record["repo"])
+        self.entries[record["repo"]] = {
+            "tag": record["tag"],
+            "asset": record["asset"],
+            "size": record["size"],
+            "digest": f"sha256:{digest}",
+        }
+        return previous
+
+    def prune(self, repo, previous):
+        """Deletes a repo's superseded file."""
+        path = self.directory / asset_path(repo, previous["asset"])
+        if path.is_file():
+            path.unlink()
+            logging.info(f"Pruned {path}")
+
+    def save(self):
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(self.entries, indent=2, sort_keys=True), encoding="utf-8")
+        tmp.replace(self.path)
+
+
+def find_next_page(soup):
+    """
+    Returns the href of the list's "Next" button. GitHub paginates star lists with
+    a BtnGroup of Previous/Next buttons; on the last page Next is a disabled
+    <button> instead of a link.
+    """
+    for a in soup.select(".paginate-container a[href], .BtnGroup a[href]"):
+        if a.get_text(strip=True) == "Next":
+            return a["href"]
+    next_page = soup.select_one("a.next_page[href], a[rel~=next][href]")
+    return next_page["href"] if next_page else None
+
+
+def parse_star_list(url, session=None, api_url=API_URL):
+    """Yields the releases API URL of every repo, following the list's pagination."""
+    # 这里请求的是 github.com 的网页，不要带上 API 的 Accept 头和 token
+    session = session or requests.Session()
+    seen = set()
+    while url and url not in seen:
+        seen.add(url)
+        html = session.get(url, timeout=30).text
+        soup = BeautifulSoup(html, "html.parser")
+        href = soup.select("#user-list-repositories .d-inline-block a")
+        for i in href:
+            yield f"{api_url}/repos{i['href']}/releases"
+        next_page = find_next_page(soup)
+        url = urljoin(url, next_page) if next_page else None
+    logging.info(f"Crawled {len(seen)} star list pages")
+
+
+def pick_asset(releases, url):
+    latest_res = releases[0]["assets"]
     if len(latest_res) == 1:
         logging.debug(f"res len == 1: {latest_res[0]['name']}")
-        return latest_res[0]["browser_download_url"]
+        return latest_res[0]
     else:
         for i in latest_res:
             name = i["name"]
             if "arm64" in name and name.endswith(".apk"):
                 logging.debug(f"has arm64: {name}")
-                return i["browser_download_url"]
+                return i
             elif "release" in name:
                 logging.debug(f"has release: {name}")
-                return i["browser_download_url"]
+                return i
             elif name.endswith(".apk"):
                 logging.debug(f"endswith .apk: {name}")
-                return i["browser_download_url"]
+                return i
     raise Exception(f"Can't parse {url}")
 
 
+def resolve_release(url, client):
+    """Resolves a releases API URL to a record of the asset to download."""
+    start = time.perf_counter()
+    releases, status = client.get_json(url)
+    asset = pick_asset(releases, url)
+    logging.info(f"Resolved {url} in {(time.perf_counter() - start) * 1000:.0f} ms ({status})")
+    return {
+        "repo": "/".join(url.rstrip("/").split("/")[-3:-1]),
+        "tag": releases[0]["tag_name"],
+        "asset": asset["name"],
+        "size": asset["size"],
+        "digest": asset.get("digest"),
+        "url": asset["browser_download_url"],
+    }
+
+
+def parse_releases_api(url, client=None):
+    if client is None:
+        return pick_asset(requests.get(url).json(), url)["browser_download_url"]
+    return resolve_release(url, client)["url"]
+
+
+def resolve_all(links, client, workers):
+    """
+    Resolves release assets concurrently and yields (link, record) pairs as soon as
+    each one is ready. A repo that fails to resolve is logged and skipped.
+    """
+    start = time.perf_counter()
+    resolved = 0
+    pending = {}
+
+    def finish(futures):
+        nonlocal resolved
+        for future in futures:
+            link = pending.pop(future)
+            try:
+                record = future.result()
+            except Exception as e:
+                logging.error(f"Failed to resolve {link}: {e}")
+                continue
+            resolved += 1
+            yield link, record
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        # 边翻页边解析，已解析完的仓库不必等整个列表爬完
+        for link in links:
+            pending[pool.submit(resolve_release, link, client)] = link
+            yield from finish([f for f in pending if f.done()])
+        yield from finish(as_completed(list(pending)))
+    logging.info(f"Resolved {resolved} repos in {time.perf_counter() - start:.2f} s")
+
+
+def partial_name(record):
+    """
+    The name aria2c downloads an asset under. It includes the tag, so a new release
+    that reuses the asset name never resumes (or keeps) the old release's bytes.
+    """
+    name = f"{record['asset']}.{record['tag'].replace('/', '_')}.part"
+    return asset_path(record["repo"], name).as_posix()
+
+
+def verify_download(record, directory):
+    """
+    Hashes a finished download and moves it to its final name; returns its digest,
+    or None on a mismatch, in which case the partial file is deleted.
+    """
+    path = Path(directory) / partial_name(record)
+    if not path.is_file() or path.stat().st_size != record["size"]:
+        logging.error(f"{path} is missing or has the wrong size")
+        path.unlink(missing_ok=True)
+        return None
+    digest = file_sha256(path)
+    expected = record.get("digest")
+    if expected and expected.startswith("sha256:") and expected[len("sha256:"):] != digest:
+        logging.error(f"{path} does not match {expected}")
+        path.unlink()
+        return None
+    path.replace(Path(directory) / asset_path(record["repo"], record["asset"]))
+    return digest
+
+
 def main(
     star_list_url: Annotated[
         str, typer.Argument(help="Like https://github.com/stars/xxx/lists/xxxxxxx")
@@ -57,12 +376,57 @@ def main(
     dir: Annotated[
         str, typer.Option(help="The directory to store the downloaded file.")
     ] = "./",
+    workers: Annotated[
+        int, typer.Option(help="How many repos to resolve at the same time.")
+    ] = 8,
+    cache_dir: Annotated[
+        Path, typer.Option(help="Where to keep ETag-validated API responses.")
+    ] = DEFAULT_CACHE_DIR,
+    token: Annotated[
+        Optional[str],
+        typer.Option(envvar="GITHUB_TOKEN", help="GitHub token; 304 answers are then free."),
+    ] = None,
+    concurrency: Annotated[
+        int, typer.Option(help="How many files aria2c downloads at the same time.")
+    ] = 4,
+    aria2c: Annotated[str, typer.Option(help="The aria2c executable.")] = "aria2c",
+    api_url: Annotated[
+        str, typer.Option(help="Base URL of the GitHub API.", hidden=True)
+    ] = API_URL,
+    prune: Annotated[
+        bool, typer.Option(help="Delete files superseded by a newer release.")
+    ] = False,
 ):
-    links = parse_star_list(star_list_url)
-    urls = []
-    for u in links:
-        urls.append(parse_releases_api(u))
-    aria2c_download(" ".join(urls), dir)
+    client = CachedClient(cache_dir, token, pool_size=workers)
+    links = parse_star_list(star_list_url, requests.Session(), api_url)
+    manifest = Manifest(dir)
+    queued = {}
+    unchanged = 0
+    with Aria2Downloader(dir, concurrency, aria2c) as downloader:
+        for _, record in resolve_all(links, client, workers):
+            if manifest.is_current(record):
+                logging.debug(f"{record['repo']} is still at {record['tag']}")
+                unchanged += 1
+                continue
+            if record["url"] not in queued:
+                downloader.add(record["url"], {"out": partial_name(record)})
+                queued[record["url"]] = record
+        failed = downloader.wait()
+
+    for url, record in queued.items():
+        if url in failed:
+            continue
+        digest = verify_download(record, dir)
+        if digest is None:
+            failed.append(url)
+            continue
+        previous = manifest.update(record, digest)
+        if prune and previous and previous["asset"] != record["asset"]:
+            manifest.prune(record["repo"], previous)
+    manifest.save()
+    logging.info(f"{unchanged} repos unchanged, {len(queued) - len(failed)} downloaded")
+    if failed:
+        raise Exception(f"Failed to download {len(failed)} files: {' '.join(failed)}")
 
 
 if __name__ == "__main__":
@@ -1,59 +1,504 @@
 from pyncm import apis
+from collections import defaultdict, deque
+from itertools import combinations
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 import argparse
+import csv
+import json
+import os
+import re
+import sqlite3
+import unicodedata
+import sys
+import time
 import pyperclip
 
+# 每页请求的歌曲数量
+PAGE_SIZE = 1000
+# 同时请求的页数上限
+FETCH_WORKERS = 8
+# 单页请求失败后的重试次数
+FETCH_RETRIES = 3
+# 每次请求歌曲详情的 ID 数量
+DETAIL_BATCH_SIZE = 1000
+# 增量同步使用的本地快照数据库
+CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "playlists.sqlite3")
 
-def get_playlist_data(playlist_id):
+
+def log(message):
+    """进度信息输出到标准错误，避免混入导出到标准输出的数据"""
+    print(message, file=sys.stderr)
+
+
+# 已登录过的 api 对象，同一进程内的多个播放列表共用一次匿名登录
+_logged_in = set()
+
+
+def ensure_login(api):
+    """匿名登录，每个 api 对象只登录一次"""
+    if id(api) not in _logged_in:
+        api.login.LoginViaAnonymousAccount()
+        _logged_in.add(id(api))
+
+
+def format_track(track):
+    """将接口返回的歌曲信息整理为 歌名/艺术家/专辑"""
+    name = track["name"]
+    album_name = track["al"]["name"]
+    artist = "/".join(artist["name"] for artist in track.get("ar", []))
+    return {"id": track["id"], "name": name, "artist": artist, "album": album_name}
+
+
+def with_retries(request, description, retries=FETCH_RETRIES):
+    """执行一次请求，失败时按指数退避重试"""
+    for attempt in range(retries + 1):
+        try:
+            return request()
+        except Exception as e:
+            if attempt == retries:
+                raise
+            delay = 0.5 * 2**attempt
+            log(f"{description}失败（{e}），{delay:.1f} 秒后重试")
+            time.sleep(delay)
+
+
+def fetch_page(api, playlist_id, offset, limit=PAGE_SIZE, retries=FETCH_RETRIES):
+    """获取一页歌曲"""
+    return with_retries(
+        lambda: api.playlist.GetPlaylistAllTracks(playlist_id, offset=offset, limit=limit)["songs"],
+        f"获取第 {offset // limit + 1} 页",
+        retries,
+    )
+
+
+def fetch_track_details(api, track_ids, workers=FETCH_WORKERS, retries=FETCH_RETRIES):
+    """按 DETAIL_BATCH_SIZE 分批并发获取歌曲详情，返回 {歌曲 ID: 歌曲信息}"""
+    batches = [
+        track_ids[i:i + DETAIL_BATCH_SIZE]
+        for i in range(0, len(track_ids), DETAIL_BATCH_SIZE)
+    ]
+    if not batches:
+        return {}
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(batches)))) as pool:
+        responses = pool.map(
+            lambda batch: with_retries(
+                lambda: api.track.GetTrackDetail(batch)["songs"],
+                f"获取 {len(batch)} 首歌曲的详情",
+                retries,
+            ),
+            batches,
+        )
+        return {track["id"]: format_track(track) for songs in responses for track in songs}
+
+
+def iter_playlist_tracks(playlist_id, api=apis, workers=FETCH_WORKERS, retries=FETCH_RETRIES):
+    """按播放列表顺序逐首产出歌曲信息
+
+    先读取歌曲总数，再并发请求分页。同时在途的分页不超过 workers 个，先到的
+    分页会等待前面的分页，因此内存占用与播放列表长度无关。api 默认为
+    pyncm.apis，测试时可以传入桩对象。
+    """
+    start = time.perf_counter()
+    ensure_login(api)
+    track_count = with_retries(
+        lambda: api.playlist.GetPlaylistInfo(playlist_id)["playlist"]["trackCount"],
+        "获取播放列表信息",
+        retries,
+    )
+
+    offsets = iter(range(0, track_count, PAGE_SIZE))
+    count = 0
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        in_flight = deque()
+        for offset in offsets:
+            in_flight.append(pool.submit(fetch_page, api, playlist_id, offset, PAGE_SIZE, retries))
+            if len(in_flight) >= workers:
+                break
+        while in_flight:
+            page = in_flight.popleft().result()
+            # 取走一页后再提交下一页，保持在途分页数量不变
+            offset = next(offsets, None)
+            if offset is not None:
+                in_flight.append(pool.submit(fetch_page, api, playlist_id, offset, PAGE_SIZE, retries))
+            for track in page:
+                count += 1
+                yield format_track(track)
+
+    elapsed = time.perf_counter() - start
+    log(f"播放列表 {playlist_id}：共获取 {count} 首歌曲，耗时 {elapsed:.2f} 秒")
+
+
+def get_playlist_data(playlist_id, api=apis, workers=FETCH_WORKERS, retries=FETCH_RETRIES):
     """获取播放列表的所有歌曲信息"""
-    apis.login.LoginViaAnonymousAccount()
-    offset = 0
-    limit = 1000
-    result = []
-
-    while True:
-        data = apis.playlist.GetPlaylistAllTracks(
-            playlist_id, offset=offset, limit=limit
-        )["songs"]
-        if not data:
-            break
-        for track in data:
-            name = track["name"]
-            album_name = track["al"]["name"]
-            artist = "/".join(artist["name"] for artist in track.get("ar", []))
-            result.append({"name": name, "artist": artist, "album": album_name})
-        offset += limit
-
-    return result
+    return list(iter_playlist_tracks(playlist_id, api, workers, retries))
+
+
+class PlaylistCache:
+    """播放列表的本地 SQLite 快照：歌曲信息按 ID 共享，每个播放列表保存有序的 ID 列表"""
+
+    def __init__(self, db_path=CACHE_PATH):
+        self.conn = sqlite3.connect(db_path)
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS tracks (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                artist TEXT NOT NULL,
+                album TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS playlist_tracks (
+                playlist_id TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                track_id INTEGER NOT NULL,
+                PRIMARY KEY (playlist_id, position)
+            );
+            CREATE TABLE IF NOT EXISTS playlists (
+                id TEXT PRIMARY KEY,
+                synced_at TEXT NOT NULL
+            );
+            """
+        )
+
+    def has_playlist(self, playlist_id):
+        return (
+            self.conn.execute(
+                "SELECT 1 FROM playlists WHERE id = ?", (str(playlist_id),)
+            ).fetchone()
+            is not None
+        )
+
+    def playlist_track_ids(self, playlist_id):
+        rows = self.conn.execute(
+            "SELECT track_id FROM playlist_tracks WHERE playlist_id = ? ORDER BY position",
+            (str(playlist_id),),
+        )
+        return [row[0] for row in rows]
+
+    def missing_track_ids(self, track_ids):
+        known = set()
+        ids = list(track_ids)
+        # SQLite 单条语句的参数数量有限，分批查询
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            rows = self.conn.execute(
+                f"SELECT id FROM tracks WHERE id IN ({','.join('?' * len(chunk))})", chunk
+            )
+            known.update(row[0] for row in rows)
+        return [track_id for track_id in ids if track_id not in known]
+
+    def get_tracks(self, track_ids):
+        """按给定顺序返回歌曲信息，缺失的歌曲会被跳过"""
+        tracks = {}
+        ids = list(track_ids)
+        for i in range(0, len(ids), 500):
+            chunk = ids[i:i + 500]
+            rows = self.conn.execute(
+                f"SELECT id, name, artist, album FROM tracks WHERE id IN ({','.join('?' * len(chunk))})",
+                chunk,
+            )
+            for track_id, name, artist, album in rows:
+                tracks[track_id] = {"id": track_id, "name": name, "artist": artist, "album": album}
+        return [tracks[track_id] for track_id in ids if track_id in tracks]
+
+    def save_tracks(self, tracks):
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO tracks (id, name, artist, album) VALUES (?, ?, ?, ?)",
+            [(t["id"], t["name"], t["artist"], t["album"]) for t in tracks],
+        )
+
+    def save_playlist(self, playlist_id, track_ids):
+        playlist_id = str(playlist_id)
+        with self.conn:
+            self.conn.execute("DELETE FROM playlist_tracks WHERE playlist_id = ?", (playlist_id,))
+            self.conn.executemany(
+                "INSERT INTO playlist_tracks (playlist_id, position, track_id) VALUES (?, ?, ?)",
+                [(playlist_id, i, track_id) for i, track_id in enumerate(track_ids)],
+            )
+            self.conn.execute(
+                "INSERT OR REPLACE INTO playlists (id, synced_at) VALUES (?, ?)",
+                (playlist_id, datetime.now().isoformat(timespec="seconds")),
+            )
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
+def sync_playlist(playlist_id, cache, api=apis, workers=FETCH_WORKERS, retries=FETCH_RETRIES):
+    """增量同步播放列表
+
+    只请求歌曲 ID 列表，与本地快照比较后，仅为快照中没有的歌曲批量请求详情。
+    播放列表未变化时只需登录和一次 ID 列表请求。
+
+    返回 (全部歌曲, 新增歌曲, 移除歌曲)，均为 format_track 格式的列表。
+    """
+    start = time.perf_counter()
+    ensure_login(api)
+    playlist = with_retries(
+        lambda: api.playlist.GetPlaylistInfo(playlist_id)["playlist"], "获取播放列表信息", retries
+    )
+    track_ids = [item["id"] for item in playlist.get("trackIds", [])]
+
+    if len(track_ids) < playlist["trackCount"]:
+        # ID 列表不完整时退回到分页获取全部歌曲
+        log("播放列表的 ID 列表不完整，改为分页获取全部歌曲")
+        tracks = get_playlist_data(playlist_id, api, workers, retries)
+        cache.save_tracks(tracks)
+        track_ids = [t["id"] for t in tracks]
+    else:
+        missing = cache.missing_track_ids(track_ids)
+        if missing:
+            details = fetch_track_details(api, missing, workers, retries)
+            cache.save_tracks(details.values())
+
+    had_snapshot = cache.has_playlist(playlist_id)
+    old_ids = cache.playlist_track_ids(playlist_id)
+    old_set, new_set = set(old_ids), set(track_ids)
+    added = cache.get_tracks(i for i in track_ids if i not in old_set) if had_snapshot else []
+    removed = cache.get_tracks(i for i in old_ids if i not in new_set)
+    cache.save_playlist(playlist_id, track_ids)
+    result = cache.get_tracks(track_ids)
+
+    elapsed = time.perf_counter() - start
+    log(f"播放列表 {playlist_id}：共 {len(result)} 首歌曲，新增 {len(added)} 首，移除 {len(removed)} 首，耗时 {elapsed:.2f} 秒")
+    return result, added, removed
+
+
+def format_line(song):
+    return f"歌名: {song['name']}; 艺术家: {song['artist']}; 专辑: {song['album']}"
 
 
 def copy_to_clipboard(song_info):
     """将格式化的歌曲信息复制到剪贴板"""
-    formatted_info = f"歌名: {song_info['name']}; 艺术家: {song_info['artist']}; 专辑: {song_info['album']}"
+    formatted_info = format_line(song_info)
     pyperclip.copy(formatted_info)
     print(f"已复制到剪贴板: {formatted_info}")
 
 
 def copy_all_to_clipboard(playlist_data):
     """将所有歌曲信息格式化并复制到剪贴板"""
-    formatted_info = "\n".join(
-        [
-            f"歌名: {song['name']}; 艺术家: {song['artist']}; 专辑: {song['album']}"
-            for song in playlist_data
-        ]
-    )
-    pyperclip.copy(formatted_info)
-    print("已复制所有歌曲信息到剪贴板。")
+    formatted_info = "\n".join(format_line(song) for song in playlist_data)
+    try:
+        pyperclip.copy(formatted_info)
+    except pyperclip.PyperclipException as e:
+        log(f"无法复制到剪贴板: {e}")
+        return
+    log("已复制所有歌曲信息到剪贴板。")
+
+
+EXPORT_FIELDS = ["playlist_id", "id", "name", "artist", "album"]
+
+
+class TrackWriter:
+    """逐首写出歌曲信息，支持 text/csv/tsv/jsonl 四种格式"""
+
+    def __init__(self, stream, fmt="text"):
+        self.stream = stream
+        self.fmt = fmt
+        self.numbers = {}
+        if fmt in ("csv", "tsv"):
+            self.csv = csv.DictWriter(
+                stream, EXPORT_FIELDS, delimiter="," if fmt == "csv" else "\t", lineterminator="\n"
+            )
+            self.csv.writeheader()
+
+    def write(self, playlist_id, song):
+        if self.fmt == "text":
+            # 每个播放列表单独编号
+            number = self.numbers[playlist_id] = self.numbers.get(playlist_id, 0) + 1
+            self.stream.write(f"{number}. {format_line(song)}\n")
+        elif self.fmt == "jsonl":
+            record = {"playlist_id": str(playlist_id), **song}
+            self.stream.write(json.dumps(record, ensure_ascii=False) + "\n")
+        else:
+            self.csv.writerow({"playlist_id": str(playlist_id), **song})
+
+
+def iter_playlists(playlist_ids, api=apis, workers=FETCH_WORKERS, cache=None):
+    """依次产出 (播放列表 ID, 歌曲迭代器)
+
+    传入 cache 时使用增量同步，并输出新增和移除的歌曲。
+    """
+    for playlist_id in playlist_ids:
+        if cache is not None:
+            tracks, added, removed = sync_playlist(playlist_id, cache, api, workers)
+            for song in added:
+                log(f"+ {format_line(song)}")
+            for song in removed:
+                log(f"- {format_line(song)}")
+            yield playlist_id, tracks
+        else:
+            yield playlist_id, iter_playlist_tracks(playlist_id, api, workers)
+
+
+def export_playlists(playlist_ids, writer, api=apis, workers=FETCH_WORKERS, cache=None, on_track=None):
+    """依次导出多个播放列表，每首歌曲到达后立即写出
+
+    on_track 会对每首歌曲额外调用一次（例如收集到剪贴板）。
+    """
+    for playlist_id, tracks in iter_playlists(playlist_ids, api, workers, cache):
+        for song in tracks:
+            writer.write(playlist_id, song)
+            if on_track is not None:
+                on_track(song)
+
+
+def normalize_text(text):
+    """统一全半角和大小写，去掉空白和标点，用于比较不同 ID 的同一首歌"""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    return re.sub(r"[\W_]+", "", text)
+
+
+def song_key(song):
+    """歌名 + 艺术家（与顺序无关）的规范化键"""
+    artists = sorted(normalize_text(a) for a in song["artist"].split("/"))
+    return normalize_text(song["name"]), "/".join(artists)
+
+
+class PlaylistIndex:
+    """多个播放列表的内存索引，用于查找重复歌曲和计算重合度
+
+    每首歌按规范化的 歌名+艺术家 归并，因此同一首歌的不同版本 ID 也会被视为重复。
+    """
+
+    def __init__(self):
+        # 规范化键 -> {播放列表 ID: [歌曲, ...]}
+        self.entries = defaultdict(lambda: defaultdict(list))
+        # 播放列表 ID -> 歌曲总数 / 规范化后不重复的歌曲数
+        self.sizes = {}
+        self.unique_sizes = {}
+
+    def add(self, playlist_id, tracks):
+        count = unique = 0
+        for song in tracks:
+            by_playlist = self.entries[song_key(song)]
+            if playlist_id not in by_playlist:
+                unique += 1
+            by_playlist[playlist_id].append(song)
+            count += 1
+        self.sizes[playlist_id] = count
+        self.unique_sizes[playlist_id] = unique
+
+    def union_size(self):
+        return len(self.entries)
+
+    def duplicates(self):
+        """返回出现在多个播放列表中、或在同一播放列表中出现多次的歌曲
+
+        每项为 (示例歌曲, {播放列表 ID: 出现次数}, 不同 ID 的数量)，按涉及的
+        播放列表数和总次数降序排列。
+        """
+        result = []
+        for by_playlist in self.entries.values():
+            total = sum(len(songs) for songs in by_playlist.values())
+            if total < 2:
+                continue
+            example = next(iter(by_playlist.values()))[0]
+            ids = {song["id"] for songs in by_playlist.values() for song in songs}
+            counts = {pid: len(songs) for pid, songs in by_playlist.items()}
+            result.append((example, counts, len(ids)))
+        result.sort(key=lambda item: (len(item[1]), sum(item[1].values())), reverse=True)
+        return result
+
+    def overlap(self):
+        """返回两两重合的歌曲数 {(播放列表 A, 播放列表 B): 共同歌曲数}
+
+        通过倒排索引只统计真正共享歌曲的播放列表对，不需要两两求交集。
+        """
+        pairs = defaultdict(int)
+        for by_playlist in self.entries.values():
+            if len(by_playlist) > 1:
+                for pair in combinations(sorted(by_playlist, key=str), 2):
+                    pairs[pair] += 1
+        return pairs
+
+
+def print_index_report(index, top=20):
+    """输出重复歌曲、两两重合度和并集大小"""
+    duplicates = index.duplicates()
+    total = sum(index.sizes.values())
+    print(f"共 {len(index.sizes)} 个播放列表，{total} 首歌曲，去重后 {index.union_size()} 首")
+
+    print(f"\n重复歌曲 {len(duplicates)} 首" + (f"（显示前 {top} 首）" if len(duplicates) > top else "") + "：")
+    for song, counts, id_count in duplicates[:top]:
+        where = "，".join(
+            f"{pid}" + (f" x{n}" if n > 1 else "") for pid, n in sorted(counts.items(), key=lambda kv: str(kv[0]))
+        )
+        note = f"（{id_count} 个不同 ID）" if id_count > 1 else ""
+        print(f"  {format_line(song)} -> {where}{note}")
+
+    overlap = sorted(index.overlap().items(), key=lambda kv: kv[1], reverse=True)
+    print("\n播放列表两两重合（共同歌曲数 / Jaccard 系数）：")
+    for (a, b), shared in overlap[:top]:
+        jaccard = shared / (index.unique_sizes[a] + index.unique_sizes[b] - shared)
+        print(f"  {a} & {b}: {shared} 首 / {jaccard:.1%}")
+    if not overlap:
+        print("  无")
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="获取网易云音乐播放列表的歌曲信息")
-    parser.add_argument("playlist_id", help="播放列表 ID")
+    parser.add_argument("playlist_ids", nargs="+", metavar="playlist_id", help="播放列表 ID，可以有多个")
+    parser.add_argument(
+        "--workers", type=int, default=FETCH_WORKERS, help="同时请求的页数上限"
+    )
+    parser.add_argument(
+        "--sync", action="store_true", help="与本地快照比较，只获取新增歌曲的详情"
+    )
+    parser.add_argument("--db", default=CACHE_PATH, help="本地快照数据库路径")
+    parser.add_argument(
+        "-f", "--format", choices=["text", "csv", "tsv", "jsonl"], default="text", help="输出格式"
+    )
+    parser.add_argument("-o", "--output", default="-", help="输出文件，默认为标准输出")
+    parser.add_argument(
+        "--analyze", action="store_true", help="不导出歌曲，改为统计播放列表之间的重复歌曲和重合度"
+    )
+    parser.add_argument("--top", type=int, default=20, help="--analyze 时每项最多显示的条数")
+    parser.add_argument(
+        "--clipboard",
+        action=argparse.BooleanOptionalAction,
+        default=None,
+        help="同时复制到剪贴板；默认仅在以文本格式输出到标准输出时开启",
+    )
     args = parser.parse_args()
 
-    playlist_data = get_playlist_data(args.playlist_id)
-    for i, song in enumerate(playlist_data, start=1):
-        print(
-            f"{i}. 歌名: {song['name']}; 艺术家: {song['artist']}; 专辑: {song['album']}"
+    if args.analyze:
+        # 只有显式传入 --sync 才更新快照，否则分析会用掉下次同步要显示的增删结果
+        cache = PlaylistCache(args.db) if args.sync else None
+        index = PlaylistIndex()
+        try:
+            for playlist_id, tracks in iter_playlists(args.playlist_ids, workers=args.workers, cache=cache):
+                index.add(playlist_id, tracks)
+        finally:
+            if cache is not None:
+                cache.close()
+        print_index_report(index, args.top)
+        sys.exit()
+
+    if args.clipboard is None:
+        args.clipboard = args.format == "text" and args.output == "-"
+
+    if args.output == "-":
+        stream = sys.stdout
+    else:
+        stream = open(args.output, "w", encoding="utf-8", newline="")
+    cache = PlaylistCache(args.db) if args.sync else None
+    clipboard = [] if args.clipboard else None
+
+    try:
+        export_playlists(
+            args.playlist_ids,
+            TrackWriter(stream, args.format),
+            workers=args.workers,
+            cache=cache,
+            on_track=clipboard.append if clipboard is not None else None,
         )
+    finally:
+        if cache is not None:
+            cache.close()
+        if stream is not sys.stdout:
+            stream.close()
 
-    copy_all_to_clipboard(playlist_data)
+    if clipboard is not None:
+        copy_all_to_clipboard(clipboard)
@@ -0,0 +1,137 @@
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+
+import main
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# 每种方式都在独立的子进程中运行，以便分别统计峰值内存
+VARIANTS = {
+    "predict_image": "nsfwpy 原有的 predict_image（全尺寸解码）",
+    "full": "批量路径，全尺寸解码",
+    "fast": "批量路径，解码时直接缩小",
+}
+
+# 不加载模型时使用的输入尺寸，与 nsfwpy 默认模型一致
+DEFAULT_DIM = 224
+
+
+def peak_rss_mib():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux 以 KiB 为单位，macOS 以字节为单位
+    return peak / 1024 / 1024 if sys.platform == "darwin" else peak / 1024
+
+
+def run_variant(variant, paths, use_model):
+    """在当前进程中运行一种方式，返回耗时、峰值内存和各图片的分数。"""
+    detector = main.NSFW() if use_model else None
+    dim = detector.image_dim if detector else DEFAULT_DIM
+    baseline_rss = peak_rss_mib()
+
+    scores = {}
+    start = time.perf_counter()
+    if variant == "predict_image":
+        for path in paths:
+            predictions = detector.predict_image(path)
+            # nsfwpy 的 predict_image 以字符串返回分数
+            score = main.get_porn_score(predictions) if predictions is not None else None
+            if score is not None:
+                scores[path] = score
+    else:
+        fast = variant == "fast"
+        for i in range(0, len(paths), main.BATCH_SIZE):
+            chunk = paths[i:i + main.BATCH_SIZE]
+            arrays = [main.load_image_array(p, dim, fast=fast) for p in chunk]
+            if detector is None:
+                continue
+            # 动图不参与比较
+            decoded = [(p, a) for p, a in zip(chunk, arrays) if a is not None]
+            if decoded:
+                predictions = main.predict_arrays(detector, [a for _, a in decoded])
+                scores.update((p, main.get_porn_score(pred)) for (p, _), pred in zip(decoded, predictions))
+    elapsed = time.perf_counter() - start
+
+    return {
+        "variant": variant,
+        "images": len(paths),
+        "seconds": elapsed,
+        "peak_rss_mib": peak_rss_mib(),
+        "baseline_rss_mib": baseline_rss,
+        "scores": scores,
+    }
+
+
+def collect_paths(folders, limit):
+    paths = []
+    for path in main.iter_image_paths(folders):
+        paths.append(path)
+        if limit and len(paths) >= limit:
+            break
+    return paths
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="比较全尺寸解码与解码时缩小两种预处理方式的耗时和内存占用")
+    parser.add_argument("folders", nargs="+", help="包含测试图片的文件夹")
+    parser.add_argument("--limit", type=int, default=200, help="最多使用的图片数量，0 表示不限")
+    parser.add_argument("--no-model", action="store_true", help="不加载模型，只比较解码和缩放")
+    parser.add_argument("--json", help="将结果写入该 JSON 文件")
+    parser.add_argument("--variant", choices=VARIANTS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    paths = collect_paths(args.folders, args.limit)
+    if not paths:
+        print("没有找到可用的测试图片。")
+        return
+
+    if args.variant:
+        # 子进程：只运行一种方式并把结果输出到标准输出
+        print(json.dumps(run_variant(args.variant, paths, not args.no_model)))
+        return
+
+    variants = [v for v in VARIANTS if not (args.no_model and v == "predict_image")]
+    results = {}
+    for variant in variants:
+        print(f"正在运行: {VARIANTS[variant]} ...")
+        command = [sys.executable, os.path.abspath(__file__), *args.folders,
+                   "--limit", str(args.limit), "--variant", variant]
+        if args.no_model:
+            command.append("--no-model")
+        output = subprocess.run(command, text=True, capture_output=True, check=True).stdout
+        results[variant] = json.loads(output.strip().splitlines()[-1])
+
+    print(f"\n共 {len(paths)} 张图片：")
+    reference = results.get("predict_image") or results["full"]
+    for variant, r in results.items():
+        line = f"  {variant:<14} {r['seconds']:8.2f} 秒  {r['seconds'] / r['images'] * 1000:8.2f} 毫秒/张"
+        if r["peak_rss_mib"] is not None:
+            line += f"  峰值内存 {r['peak_rss_mib']:8.1f} MiB（加载后增加 {r['peak_rss_mib'] - r['baseline_rss_mib']:.1f} MiB）"
+        if r is not reference and r["seconds"] > 0:
+            line += f"  加速 {reference['seconds'] / r['seconds']:.2f}x"
+        print(line)
+
+    if not args.no_model:
+        diffs = [
+            abs(results["fast"]["scores"][p] - s)
+            for p, s in results["predict_image"]["scores"].items()
+            if p in results["fast"]["scores"]
+        ]
+        if diffs:
+            print(f"\n解码时缩小与 predict_image 的 porn 分数差异：最大 {max(diffs):.4f}，平均 {sum(diffs) / len(diffs):.4f}")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({v: {k: r[k] for k in r if k != "scores"} for v, r in results.items()}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main_cli()
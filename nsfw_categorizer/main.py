@@ -1,8 +1,24 @@
 import os
+import sys
+import json
+import math
+import time
+import random
+import queue
 import shutil
+import hashlib
+import sqlite3
+import argparse
+import threading
+import multiprocessing
+from collections import defaultdict
+from contextlib import contextmanager
+import numpy as np
+import onnxruntime as ort
+from PIL import Image
 from nsfwpy import NSFW
 
-# --- 1. 配置区域 ---
+# --- 1. 配置区域（均可通过命令行参数覆盖） ---
 
 # 需要递归扫描的源文件夹列表
 SOURCE_FOLDERS = [
@@ -14,75 +30,932 @@ DESTINATION_FOLDER = r"C:\Users\Initsnow\Documents\NSFW_tmp\Pics"
 # NSFW 分数阈值
 PORN_THRESHOLD = 0.7
 
-# --- 2. 主逻辑：扫描并移动符合条件的文件 ---
-if __name__ == "__main__":
-    # 确保唯一的目标文件夹存在
-    os.makedirs(DESTINATION_FOLDER, exist_ok=True)
+# 每次送入模型的图片数量
+BATCH_SIZE = 32
 
-    print("第一步：加载 NSFW 模型...")
-    try:
-        detector = NSFW()
-        print("模型加载完成。")
-    except Exception as e:
-        print(f"错误：加载 NSFW 模型失败: {e}")
-        exit()
-
-    print("\n第二步：开始扫描并筛选图片...")
-    
-    moved_count = 0
-    
-    # 遍历你在 SOURCE_FOLDERS 中配置的每一个顶层文件夹
-    for source_folder in SOURCE_FOLDERS:
+# 解码/缩放线程数
+DECODE_WORKERS = os.cpu_count() or 4
+
+# 已解码但尚未推理的图片上限，队列满时解码线程会等待，从而保持内存占用平稳
+PREFETCH_SIZE = BATCH_SIZE * 4
+
+# 分数缓存数据库，重复运行时直接复用已有分数；设为 None 则禁用缓存
+SCORE_CACHE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "scores.sqlite3")
+
+# 路径/大小/修改时间不匹配时，是否按文件内容哈希查找缓存（可识别被重命名或移动的文件）
+USE_CONTENT_HASH = False
+
+# 按图集（每个目录一个图集）分类：先抽样打分，结论明确时整个目录一起处理
+SET_MODE = False
+
+# 每个图集最少/最多抽样的图片数，实际抽样数随图集大小的平方根增长
+SET_SAMPLE_MIN = 4
+SET_SAMPLE_MAX = 16
+
+# 抽样分数与阈值相差超过该值时视为"明确"，最少样本全部明确即可提前结束抽样
+SET_MARGIN = 0.2
+
+# 与已打分图片的 dHash 汉明距离不超过该值时直接复用其分数（共 64 位），例如 4；
+# 默认 None 即禁用。dHash 只看亮度梯度，因此还要求下面的颜色签名足够接近
+PHASH_MAX_DISTANCE = None
+
+# 近似重复图片 4x4 平均颜色（RGB，0-255）各分量允许的最大差值
+PHASH_MAX_COLOR_DIFF = 12
+
+# 近似重复索引最多保存的图片数；进入新目录或达到上限时清空，内存占用不随图库增长
+PHASH_INDEX_SIZE = 4096
+
+# 解码时直接缩小：JPEG 使用 DCT 缩放（draft 模式），其他格式分步缩小。
+# 分数与 nsfwpy 的全尺寸解码略有差异，设为 False 可恢复完全一致的预处理
+FAST_DECODE = True
+
+# 中断时等待工作进程上报计数的最长秒数，超时后直接结束进程
+RESULT_TIMEOUT = 10
+
+# 支持的图片格式
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp')
+
+
+# --- 2. 批量推理 ---
+
+def load_image_array(path, dim, fast=FAST_DECODE):
+    """
+    解码图片并预处理为模型输入，与 nsfwpy 的单张预处理保持一致。
+
+    Image.open 只读取文件头，动图在解码任何像素之前就被识别出来。fast 为 True
+    时，JPEG 由解码器直接按 1/2、1/4 或 1/8 缩放解码（结果仍不小于 dim），其他
+    格式在缩放时先做整数倍缩小，从而减少解码耗时和内存占用。
+
+    返回 (dim, dim, 3) 的 uint8 数组；动图返回 None，交给 predict_image 逐帧处理。
+    """
+    with Image.open(path) as image:
+        if getattr(image, 'is_animated', False):
+            return None
+        if fast:
+            # 仅对 JPEG 生效，须在读取像素之前调用
+            image.draft('RGB', (dim, dim))
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        resized = image.resize((dim, dim), Image.BICUBIC, reducing_gap=3.0 if fast else None)
+        return np.asarray(resized, dtype=np.uint8)
+
+
+def predict_arrays(detector, arrays):
+    """
+    将多张预处理后的图片拼成一个连续的 NumPy 批次，一次调用模型完成推理。
+
+    返回与输入顺序一致的预测字典列表。
+    """
+    dim = detector.image_dim
+    batch = np.empty((len(arrays), dim, dim, 3), dtype=np.float32)
+    for i, array in enumerate(arrays):
+        batch[i] = array
+    np.divide(batch, 255.0, out=batch)
+
+    # 部分模型的批次维度是固定的 1，此时只能逐张推理
+    batch_dim = detector.session.get_inputs()[0].shape[0]
+    if isinstance(batch_dim, int) and batch_dim == 1:
+        outputs = np.concatenate([
+            detector.session.run(detector.output_names, {detector.input_name: batch[i:i + 1]})[0]
+            for i in range(len(arrays))
+        ])
+    else:
+        outputs = detector.session.run(detector.output_names, {detector.input_name: batch})[0]
+
+    return [
+        {category: float(p) for category, p in zip(detector.CATEGORIES, row)}
+        for row in outputs
+    ]
+
+
+def dhash(array, size=8):
+    """由预处理后的图片数组计算 64 位 dHash（相邻像素亮度差的符号）。"""
+    thumbnail = Image.fromarray(array).convert('L').resize((size + 1, size), Image.BILINEAR)
+    gray = np.asarray(thumbnail, dtype=np.int16)
+    bits = (gray[:, 1:] > gray[:, :-1]).flatten()
+    return int.from_bytes(np.packbits(bits).tobytes(), 'big')
+
+
+def color_signature(array, size=4):
+    """由预处理后的图片数组计算 size x size 的平均颜色，弥补 dHash 忽略颜色和亮度的不足。"""
+    thumbnail = Image.fromarray(array).resize((size, size), Image.BOX)
+    return np.asarray(thumbnail, dtype=np.int16)
+
+
+def colors_match(a, b, max_diff=PHASH_MAX_COLOR_DIFF):
+    return int(np.abs(a - b).max()) <= max_diff
+
+
+class BKTree:
+    """按汉明距离组织的 BK 树，用于查找相近的感知哈希。"""
+
+    def __init__(self):
+        # 节点为 [哈希, 值, {距离: 子节点}]
+        self._root = None
+        self.size = 0
+
+    def add(self, image_hash, value):
+        self.size += 1
+        if self._root is None:
+            self._root = [image_hash, value, {}]
+            return
+        node = self._root
+        while True:
+            distance = (node[0] ^ image_hash).bit_count()
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [image_hash, value, {}]
+                return
+            node = child
+
+    def find(self, image_hash, max_distance, accept=None):
+        """
+        返回距离不超过 max_distance 的最近节点的值，没有时返回 None。
+
+        给出 accept 时只考虑 accept(值) 为真的节点。
+        """
+        best = None
+        best_distance = max_distance + 1
+        stack = [self._root] if self._root is not None else []
+        while stack:
+            node = stack.pop()
+            distance = (node[0] ^ image_hash).bit_count()
+            if distance < best_distance and (accept is None or accept(node[1])):
+                best, best_distance = node[1], distance
+            # 三角不等式：只有距离在 [d - r, d + r] 内的子树可能包含结果
+            for child_distance, child in node[2].items():
+                if distance - max_distance <= child_distance <= distance + max_distance:
+                    stack.append(child)
+        return best
+
+
+# --- 3. 分数缓存 ---
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """计算文件内容的 BLAKE2b 哈希。"""
+    h = hashlib.blake2b(digest_size=20)
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class ScoreCache:
+    """
+    以 SQLite 保存每张图片的预测结果。
+
+    以路径、文件大小和修改时间判断缓存是否有效；开启内容哈希后，路径未命中时
+    还会按 (大小, 哈希) 查找，从而识别被重命名或移动过的文件。连接在多个线程间
+    共享，所有访问都经过同一把锁。
+    """
+
+    def __init__(self, db_path, use_content_hash=False):
+        self.use_content_hash = use_content_hash
+        self._lock = threading.Lock()
+        # 多个工作进程共用同一个数据库，写入冲突时最多等待 30 秒
+        self._conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self._conn.executescript("""
+            PRAGMA journal_mode = WAL;
+            CREATE TABLE IF NOT EXISTS scores (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                digest TEXT,
+                predictions TEXT NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS scores_digest ON scores (size, digest);
+        """)
+
+    def lookup(self, path):
+        """
+        查找图片的缓存分数。
+
+        返回 (预测字典或 None, 缓存键)，缓存键在打分后原样传给 store()。
+        """
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        key = (st.st_size, st.st_mtime_ns, None)
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size, mtime_ns, predictions FROM scores WHERE path = ?", (path,)
+            ).fetchone()
+        if row and row[0] == st.st_size and row[1] == st.st_mtime_ns:
+            return json.loads(row[2]), key
+        if not self.use_content_hash:
+            return None, key
+
+        key = (st.st_size, st.st_mtime_ns, file_digest(path))
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT predictions FROM scores WHERE size = ? AND digest = ? LIMIT 1",
+                (st.st_size, key[2]),
+            ).fetchone()
+        if row is None:
+            return None, key
+        predictions = json.loads(row[0])
+        # 记住新路径，下次按路径即可命中；立即提交，免得写锁一直占到下次 flush，
+        # 让其他工作进程等到 "database is locked"
+        self.store(path, key, predictions)
+        self.commit()
+        return predictions, key
+
+    def store(self, path, key, predictions):
+        size, mtime_ns, digest = key
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO scores (path, size, mtime_ns, digest, predictions) VALUES (?, ?, ?, ?, ?)",
+                (os.path.abspath(path), size, mtime_ns, digest, json.dumps(predictions)),
+            )
+
+    def rename(self, old_path, new_path):
+        """文件被移动后，让缓存记录跟随新路径。改动立即提交，不占用写锁。"""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE OR REPLACE scores SET path = ? WHERE path = ?",
+                (os.path.abspath(new_path), os.path.abspath(old_path)),
+            )
+            self._conn.commit()
+
+    def commit(self):
+        with self._lock:
+            self._conn.commit()
+
+    def close(self):
+        with self._lock:
+            self._conn.commit()
+            self._conn.close()
+
+
+# --- 4. 流水线各阶段 ---
+
+# 队列结束标记
+_DONE = object()
+
+
+class StageTimer:
+    """线程安全地累计各阶段（walk、decode、infer、move）的耗时。"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.totals = defaultdict(float)
+
+    @contextmanager
+    def measure(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(stage, time.perf_counter() - start)
+
+    def add(self, stage, seconds):
+        with self._lock:
+            self.totals[stage] += seconds
+
+
+class Run:
+    """
+    一次运行（多进程时为一个工作进程）共享的状态：模型、命令行参数、缓存、
+    近似重复索引、计数和各阶段耗时。
+    """
+
+    def __init__(self, detector, options, cache=None):
+        self.detector = detector
+        self.options = options
+        self.cache = cache
+        self.near_duplicates = BKTree() if options.phash_distance is not None else None
+        self.stats = defaultdict(int)
+        self.timer = StageTimer()
+
+
+def iter_image_paths(source_folders):
+    """递归遍历源文件夹，产出所有支持格式的图片路径。"""
+    for source_folder in source_folders:
         if not os.path.isdir(source_folder):
             print(f"\n--- 警告：跳过不存在的文件夹: {source_folder} ---")
             continue
 
         print(f"\n--- 正在递归扫描: {source_folder} ---")
-        
+
         # 使用 os.walk() 进行递归遍历
         for dirpath, _, filenames in os.walk(source_folder):
             for filename in filenames:
-                source_path = os.path.join(dirpath, filename)
-                
                 # 确保是支持的图片格式
-                if not filename.lower().endswith(('.png', '.jpg', '.jpeg', '.gif', '.bmp')):
-                    continue
-
-                print(f"\n  正在检查: {source_path}")
-                
-                try:
-                    predictions = detector.predict_image(source_path)
-                    
-                    if predictions is None:
-                        print(f"    -> 无法预测，可能文件已损坏或格式不受支持。")
-                        continue
+                if filename.lower().endswith(IMAGE_EXTENSIONS):
+                    yield os.path.join(dirpath, filename)
+
+
+def timed_iter(iterable, timer, stage):
+    """逐个产出 iterable 的元素，并把取出每个元素的耗时计入 stage。"""
+    iterator = iter(iterable)
+    while True:
+        with timer.measure(stage):
+            item = next(iterator, _DONE)
+        if item is _DONE:
+            return
+        yield item
+
+
+def walk_stage(paths, path_queue, decode_workers):
+    """将图片路径逐个放入队列；结束时为每个解码线程放入一个结束标记。"""
+    try:
+        for path in paths:
+            path_queue.put(path)
+    finally:
+        for _ in range(decode_workers):
+            path_queue.put(_DONE)
 
-                    porn_value = predictions.get('porn', 0.0)
-                    
-                    try:
-                        porn_score = float(porn_value)
-                    except (ValueError, TypeError):
-                        print(f"    -> 警告：'porn' 分数 '{porn_value}' 无法转换为数字，跳过。")
+
+def decode_stage(run, path_queue, decoded_queue):
+    """
+    查询缓存，未命中时解码并缩放图片，将 (路径, 类型, 内容, 缓存键) 放入队列。
+
+    类型为 "cached"、"array"、"animated" 或 "error"；"array" 的内容为
+    (数组, (dHash, 颜色签名))，未启用近似重复检测时后者为 None。结束时放入一个
+    结束标记。
+    """
+    while (path := path_queue.get()) is not _DONE:
+        key = None
+        try:
+            with run.timer.measure("decode"):
+                if run.cache is not None:
+                    predictions, key = run.cache.lookup(path)
+                    if predictions is not None:
+                        item = (path, "cached", predictions, key)
                         continue
-                    
-                    print(f"    -> Porn 分数: {porn_score:.4f}")
-                    
-                    # 如果分数超过阈值，则移动到唯一的指定文件夹
-                    if porn_score > PORN_THRESHOLD:
-                        destination_path = os.path.join(DESTINATION_FOLDER, filename)
-                        
-                        if os.path.exists(destination_path):
-                            print(f"    -> 目标文件夹已存在同名文件，跳过移动。")
-                        else:
-                            shutil.move(source_path, destination_path)
-                            print(f"    -> 符合条件，已移动到 '{DESTINATION_FOLDER}'")
-                            moved_count += 1
-                    else:
-                        print(f"    -> 分数未达标。")
-
-                except Exception as e:
-                    print(f"    -> 处理文件时发生未知错误: {e}")
-                    
-    # --- 3. 最终总结 ---
+                array = load_image_array(path, run.detector.image_dim, run.options.fast_decode)
+                if array is None:
+                    item = (path, "animated", None, key)
+                elif run.near_duplicates is not None:
+                    item = (path, "array", (array, (dhash(array), color_signature(array))), key)
+                else:
+                    item = (path, "array", (array, None), key)
+        except Exception as e:
+            item = (path, "error", e, key)
+        finally:
+            decoded_queue.put(item)
+    decoded_queue.put(_DONE)
+
+
+def move_stage(run, move_queue):
+    """在后台移动达标的图片，不阻塞推理。"""
+    destination_folder = run.options.dest
+    while (source_path := move_queue.get()) is not _DONE:
+        try:
+            filename = os.path.basename(source_path)
+            destination_path = os.path.join(destination_folder, filename)
+
+            if os.path.exists(destination_path):
+                print(f"    -> 目标文件夹已存在同名文件，跳过移动: {source_path}")
+            else:
+                with run.timer.measure("move"):
+                    shutil.move(source_path, destination_path)
+                    if run.cache is not None:
+                        run.cache.rename(source_path, destination_path)
+                print(f"    -> 符合条件，已移动到 '{destination_folder}': {source_path}")
+                run.stats["moved"] += 1
+        except Exception as e:
+            print(f"    -> 移动文件时发生错误: {source_path} ({e})")
+
+
+def score_images(run, paths, batch_size=None, decode_workers=None):
+    """
+    以流水线方式为图片按批次打分。
+
+    一个线程从 paths（可以是遍历目录的生成器）中取出路径，多个线程查询缓存、
+    解码并缩放图片，结果经有界队列交给调用方所在的线程推理。逐个产出
+    (路径, 预测字典或 None)；无法批量处理的图片回退到 predict_image。
+
+    启用近似重复检测时，与同一目录中已打分图片的 dHash 距离不超过
+    --phash-distance、颜色签名也相近的图片直接复用其分数，不再经过模型；借来的
+    分数不写入缓存。run.stats 中会累计 "cached"、"inferred" 和 "near_duplicate"
+    三项计数。
+    """
+    options = run.options
+    batch_size = batch_size or options.batch_size
+    decode_workers = decode_workers or options.decode_workers
+    path_queue = queue.Queue(maxsize=options.prefetch)
+    decoded_queue = queue.Queue(maxsize=options.prefetch)
+
+    threading.Thread(
+        target=walk_stage, args=(paths, path_queue, decode_workers), daemon=True
+    ).start()
+    for _ in range(decode_workers):
+        threading.Thread(
+            target=decode_stage, args=(run, path_queue, decoded_queue), daemon=True
+        ).start()
+
+    # 待推理的图片：(路径, 缓存键, 数组, 分数占位)。分数占位同时登记在
+    # near_duplicates 中，同一批次内的近似重复图片会挂在它的 followers 上
+    pending = []
+    index_dir = None
+
+    def remember(path, key, predictions):
+        if run.cache is not None and key is not None and predictions is not None:
+            run.cache.store(path, key, predictions)
+
+    def infer_each():
+        """整批推理失败时逐张重试，仍然失败的图片得到 None。"""
+        predictions = []
+        for path, _, array, _ in pending:
+            try:
+                with run.timer.measure("infer"):
+                    predictions.append(predict_arrays(run.detector, [array])[0])
+            except Exception as e:
+                print(f"\n  推理失败: {path} ({e})")
+                predictions.append(None)
+        return predictions
+
+    def flush():
+        try:
+            with run.timer.measure("infer"):
+                predictions = predict_arrays(run.detector, [array for _, _, array, _ in pending])
+        except Exception as e:
+            print(f"\n  批量推理失败，改为逐张推理 ({e})")
+            predictions = infer_each()
+        results = []
+        for (path, key, _, slot), p in zip(pending, predictions):
+            if p is None:
+                # 失败的占位不再接收近似重复图片，已挂上的随它一起产出 None
+                slot["failed"] = True
+            else:
+                run.stats["inferred"] += 1
+                remember(path, key, p)
+            slot["predictions"] = p
+            results.append((path, p))
+            for follower_path in slot["followers"]:
+                results.append((follower_path, p))
+            slot["followers"].clear()
+        if run.cache is not None:
+            run.cache.commit()
+        pending.clear()
+        return results
+
+    remaining = decode_workers
+    while remaining:
+        item = decoded_queue.get()
+        if item is _DONE:
+            remaining -= 1
+            continue
+
+        path, kind, payload, key = item
+        if kind == "cached":
+            run.stats["cached"] += 1
+            yield path, payload
+            continue
+
+        if kind == "error":
+            print(f"\n  无法解码: {path} ({payload})")
+            yield path, None
+            continue
+
+        if kind == "animated":
+            try:
+                with run.timer.measure("infer"):
+                    predictions = run.detector.predict_image(path)
+            except Exception as e:
+                print(f"\n  推理失败: {path} ({e})")
+                yield path, None
+                continue
+            run.stats["inferred"] += 1
+            remember(path, key, predictions)
+            if run.cache is not None:
+                run.cache.commit()
+            yield path, predictions
+            continue
+
+        array, signature = payload
+        slot = {"predictions": None, "followers": []}
+        if run.near_duplicates is not None:
+            image_hash, colors = signature
+            slot["colors"] = colors
+            directory = os.path.dirname(path)
+            if directory != index_dir or run.near_duplicates.size >= PHASH_INDEX_SIZE:
+                # 等待推理的分数占位仍由 pending 持有，清空索引不影响它们
+                run.near_duplicates = BKTree()
+                index_dir = directory
+            match = run.near_duplicates.find(
+                image_hash, options.phash_distance,
+                accept=lambda other: not other.get("failed") and colors_match(other["colors"], colors),
+            )
+            if match is not None:
+                # 借来的分数不写入缓存，下次运行时仍会重新判断
+                run.stats["near_duplicate"] += 1
+                if match["predictions"] is None:
+                    # 相似的图片还在等待推理，随它一起产出
+                    match["followers"].append(path)
+                else:
+                    yield path, match["predictions"]
+                continue
+            run.near_duplicates.add(image_hash, slot)
+
+        pending.append((path, key, array, slot))
+        if len(pending) >= batch_size:
+            yield from flush()
+
+    if pending:
+        yield from flush()
+
+
+# --- 5. 图集模式 ---
+
+def get_porn_score(predictions):
+    """取出 'porn' 分数，无法转换为数字时返回 None。"""
+    try:
+        return float(predictions.get('porn', 0.0))
+    except (ValueError, TypeError):
+        return None
+
+
+def iter_image_sets(source_folders):
+    """
+    按目录产出图集 (目录, 图片路径列表, 是否为叶子目录)。
+
+    只有叶子目录（没有子目录、且不是源文件夹本身）可以整体移动。
+    """
+    for source_folder in source_folders:
+        if not os.path.isdir(source_folder):
+            print(f"\n--- 警告：跳过不存在的文件夹: {source_folder} ---")
+            continue
+
+        print(f"\n--- 正在递归扫描: {source_folder} ---")
+
+        for dirpath, dirnames, filenames in os.walk(source_folder):
+            images = [
+                os.path.join(dirpath, f) for f in sorted(filenames)
+                if f.lower().endswith(IMAGE_EXTENSIONS)
+            ]
+            if images:
+                is_leaf = not dirnames and os.path.abspath(dirpath) != os.path.abspath(source_folder)
+                yield dirpath, images, is_leaf
+
+
+def classify_set(run, images, results):
+    """
+    对图集做自适应抽样，判断整组图片是否都高于阈值。
+
+    每轮抽取 SET_SAMPLE_MIN 张，直到达到随图集大小增长的抽样上限。样本落在
+    阈值两侧时立即判为不确定；最少样本全部远离阈值时提前结束。已打分的样本
+    会写入 results，供不确定时逐张处理复用。
+
+    返回 True（整组高于阈值）、False（整组低于阈值）或 None（不确定）。
+    """
+    threshold = run.options.threshold
+    # 以目录名为种子，保证同一图集每次抽到相同的样本
+    order = random.Random(os.path.dirname(images[0])).sample(images, len(images))
+    target = min(len(order), max(SET_SAMPLE_MIN, min(SET_SAMPLE_MAX, math.ceil(math.sqrt(len(order))))))
+
+    sides = set()
+    uncertain = 0
+    sampled = 0
+    while sampled < target:
+        chunk = order[sampled:sampled + SET_SAMPLE_MIN]
+        sampled += len(chunk)
+        for path, predictions in score_images(run, chunk, batch_size=len(chunk), decode_workers=len(chunk)):
+            results[path] = predictions
+            score = get_porn_score(predictions) if predictions is not None else None
+            if score is None:
+                continue
+            sides.add(score > threshold)
+            if abs(score - threshold) < SET_MARGIN:
+                uncertain += 1
+
+        if len(sides) > 1:
+            return None
+        if sides and not uncertain and sampled >= SET_SAMPLE_MIN:
+            return sides.pop()
+
+    if len(sides) == 1:
+        return sides.pop()
+    return None
+
+
+def move_set(run, dirpath, images):
+    """将整个图集目录一次性移动到目标文件夹下的同名目录。"""
+    destination_path = os.path.join(run.options.dest, os.path.basename(dirpath))
+    if os.path.exists(destination_path):
+        print(f"    -> 目标文件夹已存在同名目录，跳过移动: {dirpath}")
+        return
+    with run.timer.measure("move"):
+        shutil.move(dirpath, destination_path)
+        if run.cache is not None:
+            for path in images:
+                run.cache.rename(path, os.path.join(destination_path, os.path.basename(path)))
+    print(f"    -> 整个图集符合条件，已移动到 '{destination_path}'")
+    run.stats["moved"] += len(images)
+    run.stats["moved_sets"] += 1
+
+
+# --- 6. 主逻辑：扫描并移动符合条件的文件 ---
+
+def handle_prediction(run, source_path, predictions, move_queue):
+    """打印单张图片的分数，超过阈值时交给后台线程移动。"""
+    print(f"\n  正在检查: {source_path}")
+
+    try:
+        if predictions is None:
+            print(f"    -> 无法预测，可能文件已损坏或格式不受支持。")
+            return
+
+        porn_score = get_porn_score(predictions)
+        if porn_score is None:
+            print(f"    -> 警告：'porn' 分数 '{predictions.get('porn')}' 无法转换为数字，跳过。")
+            return
+
+        print(f"    -> Porn 分数: {porn_score:.4f}")
+
+        # 如果分数超过阈值，则交给后台线程移动到唯一的指定文件夹
+        if porn_score > run.options.threshold:
+            move_queue.put(source_path)
+        else:
+            print(f"    -> 分数未达标。")
+
+    except Exception as e:
+        print(f"    -> 处理文件时发生未知错误: {e}")
+
+
+def run_set_mode(run, image_sets, move_queue):
+    """按图集处理：结论明确的图集整体移动或跳过，不确定的图集逐张打分。"""
+    for dirpath, images, is_leaf in image_sets:
+        print(f"\n  正在抽样图集: {dirpath} ({len(images)} 张)")
+        results = {}
+        verdict = classify_set(run, images, results)
+
+        if verdict is False:
+            print(f"    -> 抽样 {len(results)} 张，整组分数未达标，跳过。")
+            run.stats["skipped_sets"] += 1
+            continue
+
+        if verdict is True and is_leaf:
+            print(f"    -> 抽样 {len(results)} 张，整组分数达标。")
+            move_set(run, dirpath, images)
+            continue
+
+        if verdict is True:
+            # 目录下还有子目录，不能整体移动，直接逐张移动其中的图片
+            print(f"    -> 抽样 {len(results)} 张，整组分数达标，逐张移动。")
+            for path in images:
+                move_queue.put(path)
+            continue
+
+        print(f"    -> 抽样 {len(results)} 张，结论不确定，逐张打分。")
+        run.stats["ambiguous_sets"] += 1
+        remaining = [p for p in images if p not in results]
+        for path, predictions in results.items():
+            handle_prediction(run, path, predictions, move_queue)
+        for path, predictions in score_images(run, remaining):
+            handle_prediction(run, path, predictions, move_queue)
+
+
+def process_tasks(run, tasks):
+    """
+    处理一串任务：普通模式下是图片路径，图集模式下是 iter_image_sets 产出的图集。
+
+    每批推理结果都会立即写入缓存，中途中断后重新运行即可从断点继续。
+    """
+    move_queue = queue.Queue(maxsize=run.options.prefetch)
+    mover = threading.Thread(target=move_stage, args=(run, move_queue))
+    mover.start()
+
+    try:
+        if run.options.set_mode:
+            run_set_mode(run, tasks, move_queue)
+        else:
+            for source_path, predictions in score_images(run, tasks):
+                handle_prediction(run, source_path, predictions, move_queue)
+    finally:
+        # 等待已排队的文件移动完成
+        move_queue.put(_DONE)
+        mover.join()
+        if run.cache is not None:
+            run.cache.close()
+
+
+def load_detector(intra_threads=None):
+    print("加载 NSFW 模型...")
+    detector = NSFW()
+    if intra_threads:
+        # nsfwpy 创建会话时不接受 SessionOptions，这里按指定线程数重新创建会话
+        session_options = ort.SessionOptions()
+        session_options.intra_op_num_threads = intra_threads
+        session_options.inter_op_num_threads = 1
+        detector.session = ort.InferenceSession(
+            detector.model_path, session_options, providers=detector.session.get_providers()
+        )
+    print("模型加载完成。")
+    return detector
+
+
+def open_cache(options):
+    return ScoreCache(options.cache, options.content_hash) if options.cache else None
+
+
+def worker_main(options, task_queue, result_queue):
+    """工作进程入口：只加载一次模型，处理任务队列直到收到 None。"""
+    stats, timings = {}, {}
+    try:
+        run = Run(load_detector(options.intra_threads), options, open_cache(options))
+        try:
+            process_tasks(run, iter(task_queue.get, None))
+        finally:
+            stats, timings = dict(run.stats), dict(run.timer.totals)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        result_queue.put((stats, timings))
+
+
+def run_workers(options, tasks, timer):
+    """
+    将任务分发给多个工作进程，返回合并后的计数和各阶段耗时。
+
+    主进程负责遍历目录，工作进程从同一个有界队列中取任务，处理得快的进程
+    自然会分到更多任务。
+    """
+    task_queue = multiprocessing.Queue(maxsize=options.prefetch)
+    result_queue = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(target=worker_main, args=(options, task_queue, result_queue))
+        for _ in range(options.workers)
+    ]
+    for worker in workers:
+        worker.start()
+
+    def wait_for(action, *args):
+        # 所有工作进程都意外退出时不再无限等待
+        while True:
+            try:
+                return action(*args, timeout=1)
+            except (queue.Full, queue.Empty):
+                if not any(worker.is_alive() for worker in workers):
+                    raise RuntimeError("所有工作进程都已退出")
+
+    stats, timings = defaultdict(int), defaultdict(float)
+    completed = False
+    try:
+        for task in timed_iter(tasks, timer, "walk"):
+            wait_for(task_queue.put, task)
+        completed = True
+    finally:
+        # 中断或工作进程已全部退出时，队列可能仍是满的，结束标记只尽力放入
+        for _ in workers:
+            try:
+                if completed:
+                    wait_for(task_queue.put, None)
+                else:
+                    task_queue.put_nowait(None)
+            except (queue.Full, RuntimeError):
+                break
+        if not completed:
+            task_queue.cancel_join_thread()
+
+        # 中断时最多等待 RESULT_TIMEOUT 秒收集各进程的计数
+        deadline = time.monotonic() + RESULT_TIMEOUT
+        pending = len(workers)
+        while pending:
+            try:
+                worker_stats, worker_timings = result_queue.get(timeout=1)
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    break
+                if not completed and time.monotonic() > deadline:
+                    break
+                continue
+            pending -= 1
+            for k, v in worker_stats.items():
+                stats[k] += v
+            for k, v in worker_timings.items():
+                timings[k] += v
+
+        for worker in workers:
+            if not completed and worker.is_alive():
+                worker.terminate()
+            worker.join()
+    return stats, timings
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="按 NSFW 分数筛选图片，将超过阈值的图片移动到目标文件夹。")
+    parser.add_argument(
+        "sources", nargs="*", default=SOURCE_FOLDERS,
+        help="需要递归扫描的源文件夹，默认为脚本中的 SOURCE_FOLDERS",
+    )
+    parser.add_argument("-d", "--dest", default=DESTINATION_FOLDER, help="输出文件夹")
+    parser.add_argument("-t", "--threshold", type=float, default=PORN_THRESHOLD, help="porn 分数阈值")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="工作进程数，每个进程各自加载一次模型")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE, help="每次送入模型的图片数量")
+    parser.add_argument(
+        "--decode-workers", type=int, default=None,
+        help="每个进程的解码线程数，默认按核心数在进程间平分",
+    )
+    parser.add_argument("--prefetch", type=int, default=PREFETCH_SIZE, help="已解码待推理图片的上限")
+    parser.add_argument("--cache", default=SCORE_CACHE_PATH, help="分数缓存数据库路径")
+    parser.add_argument("--no-cache", dest="cache", action="store_const", const=None, help="禁用分数缓存")
+    parser.add_argument(
+        "--content-hash", action="store_true", default=USE_CONTENT_HASH,
+        help="缓存未命中时按内容哈希查找，可识别被重命名或移动的文件",
+    )
+    parser.add_argument("--set-mode", action="store_true", default=SET_MODE, help="按图集抽样分类")
+    parser.add_argument(
+        "--phash-distance", type=int, default=PHASH_MAX_DISTANCE,
+        help="复用近似重复图片分数的 dHash 距离上限（例如 4），默认不启用",
+    )
+    parser.add_argument(
+        "--no-phash", dest="phash_distance", action="store_const", const=None, help="禁用近似重复检测",
+    )
+    parser.add_argument(
+        "--full-decode", dest="fast_decode", action="store_false", default=FAST_DECODE,
+        help="全尺寸解码，与 nsfwpy 的预处理完全一致",
+    )
+    parser.add_argument("--metrics-json", help="将各阶段耗时和计数写入该 JSON 文件")
+    return parser
+
+
+def main():
+    options = build_parser().parse_args()
+    options.workers = max(1, options.workers)
+    if options.decode_workers is None:
+        options.decode_workers = max(1, DECODE_WORKERS // options.workers)
+    # 多进程时每个进程的 ONNX Runtime 线程数按核心数平分，避免相互争抢
+    options.intra_threads = max(1, (os.cpu_count() or 1) // options.workers) if options.workers > 1 else None
+
+    # 确保唯一的目标文件夹存在
+    os.makedirs(options.dest, exist_ok=True)
+
+    print(
+        f"开始扫描并筛选图片（{options.workers} 个进程，批次大小 {options.batch_size}，"
+        f"每个进程 {options.decode_workers} 个解码线程）..."
+    )
+
+    if options.set_mode:
+        tasks = iter_image_sets(options.sources)
+    else:
+        tasks = iter_image_paths(options.sources)
+
+    start_time = time.perf_counter()
+    interrupted = False
+    stats, timings = defaultdict(int), defaultdict(float)
+    try:
+        if options.workers == 1:
+            try:
+                detector = load_detector()
+            except Exception as e:
+                print(f"错误：加载 NSFW 模型失败: {e}")
+                sys.exit(1)
+            run = Run(detector, options, open_cache(options))
+            try:
+                process_tasks(run, timed_iter(tasks, run.timer, "walk"))
+            finally:
+                stats, timings = run.stats, run.timer.totals
+        else:
+            walk_timer = StageTimer()
+            try:
+                stats, timings = run_workers(options, tasks, walk_timer)
+            finally:
+                timings["walk"] = walk_timer.totals["walk"]
+    except KeyboardInterrupt:
+        interrupted = True
+    elapsed = time.perf_counter() - start_time
+
+    if interrupted:
+        print("\n\n--- 已中断。已完成的分数都已写入缓存，重新运行即可继续。---")
+        return
+
+    # --- 7. 最终总结 ---
+    # 每张图片的分数恰好来自缓存、近似重复或模型推理之一，图集抽样的图片也包括在内
+    stats["scored"] = stats["cached"] + stats["near_duplicate"] + stats["inferred"]
     print("\n\n--- 所有处理完成！---")
-    print(f"总共移动了 {moved_count} 个文件到 '{DESTINATION_FOLDER}'")
\ No newline at end of file
+    print(f"总共移动了 {stats['moved']} 个文件到 '{options.dest}'")
+    if elapsed > 0:
+        print(f"共为 {stats['scored']} 张图片打分，用时 {elapsed:.1f} 秒，{stats['scored'] / elapsed:.1f} 张/秒")
+    print(
+        f"其中 {stats['cached']} 张来自缓存，{stats['near_duplicate']} 张复用了近似重复图片的分数，"
+        f"{stats['inferred']} 张经过模型推理"
+    )
+    looked_up = stats['near_duplicate'] + stats['inferred']
+    if options.phash_distance is not None and looked_up:
+        print(f"近似重复跳过率: {stats['near_duplicate'] / looked_up:.1%}")
+    if options.set_mode:
+        print(
+            f"图集：整体移动 {stats['moved_sets']} 个，整体跳过 {stats['skipped_sets']} 个，"
+            f"逐张处理 {stats['ambiguous_sets']} 个"
+        )
+    # 解码和移动由多个线程/进程并行执行，这里是各线程耗时之和
+    print("各阶段累计耗时: " + "，".join(
+        f"{stage} {timings.get(stage, 0.0):.1f} 秒" for stage in ("walk", "decode", "infer", "move")
+    ))
+
+    if options.metrics_json:
+        metrics = {
+            "workers": options.workers,
+            "wall_seconds": elapsed,
+            "images_per_second": stats['scored'] / elapsed if elapsed > 0 else None,
+            "stages": {stage: timings.get(stage, 0.0) for stage in ("walk", "decode", "infer", "move")},
+            "stats": dict(stats),
+        }
+        with open(options.metrics_json, "w", encoding="utf-8") as f:
+            json.dump(metrics, f, ensure_ascii=False, indent=2)
+        print(f"指标已写入 {options.metrics_json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,232 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import re
+import json
+import random
+import shutil
+import argparse
+import tempfile
+import subprocess
+import contextlib
+from time import perf_counter
+from pathlib import Path
+from datetime import datetime
+
+import obsidian_attachment_organize as organizer
+
+WIKILINK_PATTERN = re.compile(r'!*\[\[([^|\]#]+)')
+
+
+def generate_vault(root, notes=200, attachments=400, links_per_note=5,
+                   duplicate_ratio=0.1, depth=3, seed=0):
+    """
+    Generates a reproducible synthetic Obsidian vault.
+
+    Args:
+        root (Path): The directory to create the vault in. Must not exist.
+        notes (int): The number of Markdown notes.
+        attachments (int): The number of attachment files.
+        links_per_note (int): The average number of attachment links per note.
+        duplicate_ratio (float): The share of attachments whose file name is
+            reused by another attachment in a different folder.
+        depth (int): The maximum folder nesting depth.
+        seed (int): The random seed.
+
+    Returns:
+        list of Path: The generated Markdown notes.
+    """
+    rng = random.Random(seed)
+    root.mkdir(parents=True)
+
+    folders = [root]
+    for i in range(max(1, notes // 20)):
+        parent = rng.choice([f for f in folders if len(f.relative_to(root).parts) < depth] or [root])
+        folder = parent / f"folder {i}"
+        folder.mkdir(exist_ok=True)
+        folders.append(folder)
+
+    names = []
+    for i in range(attachments):
+        if names and rng.random() < duplicate_ratio:
+            names.append(rng.choice(names))
+        else:
+            names.append(f"Pasted image 2024{i:010d}.png")
+    for name in names:
+        # 同名附件必须位于不同的文件夹中，文件夹用完时同名文件会被覆盖
+        free = [f for f in folders if not (f / name).exists()]
+        folder = rng.choice(free or folders)
+        (folder / name).write_bytes(rng.randbytes(rng.randint(256, 4096)))
+
+    note_paths = [rng.choice(folders) / f"note {i}.md" for i in range(notes)]
+    note_names = [p.stem for p in note_paths]
+    for path in note_paths:
+        lines = [f"# {path.stem}", ""]
+        for _ in range(max(0, round(rng.gauss(links_per_note, links_per_note / 3)))):
+            name = rng.choice(names)
+            lines.append(rng.choice([f"![[{name}]]", f"![[{name}|300]]", f"[[{name}]]"]))
+        # 混入一些指向其他笔记的链接，它们不应被当作附件
+        lines.append(f"参见 [[{rng.choice(note_names)}]]。")
+        path.write_text("\n".join(lines) + "\n", encoding='utf-8')
+    return note_paths
+
+
+def time_stage(func, *args, **kwargs):
+    start = perf_counter()
+    result = func(*args, **kwargs)
+    return perf_counter() - start, result
+
+
+def index_vault(vault_path):
+    count = 0
+    for _, _, files in os.walk(vault_path):
+        count += len(files)
+    return count
+
+
+def resolve_links(note_paths, vault_path):
+    """Resolves every unique link the same way process_markdown_file does."""
+    resolved = 0
+    for note in note_paths:
+        content = note.read_text(encoding='utf-8')
+        for link_name in set(WIKILINK_PATTERN.findall(content)):
+            link_name = link_name.strip()
+            if organizer.find_file_in_vault(f"{link_name}.md", str(vault_path)):
+                continue
+            if organizer.find_file_in_vault(link_name, str(vault_path)):
+                resolved += 1
+    return resolved
+
+
+def rewrite_links(note_paths, attachments_folder="attachments"):
+    """Rewrites every link in memory without touching the file system."""
+    rewritten = 0
+    for note in note_paths:
+        content = note.read_text(encoding='utf-8')
+        for link_name in set(WIKILINK_PATTERN.findall(content)):
+            pattern = re.compile(r'(!?\[\[)(' + re.escape(link_name.strip()) + r')(?=[|\]#])')
+            content = pattern.sub(rf'\g<1>{attachments_folder}/\g<2>', content)
+            rewritten += 1
+    return rewritten
+
+
+def organize_vault(note_paths, vault_path):
+    """Runs process_markdown_file on every note, discarding its output."""
+    with contextlib.redirect_stdout(io.StringIO()):
+        for note in note_paths:
+            organizer.process_markdown_file(note, vault_path)
+    return len(note_paths)
+
+
+def run_benchmark(workdir, params):
+    vault_path = workdir / "vault"
+    gen_time, note_paths = time_stage(generate_vault, vault_path, **params)
+    timings = {"generate": gen_time}
+    timings["index"], files = time_stage(index_vault, vault_path)
+    timings["resolve"], _ = time_stage(resolve_links, note_paths, vault_path)
+    timings["rewrite"], _ = time_stage(rewrite_links, note_paths)
+    timings["organize"], _ = time_stage(organize_vault, note_paths, vault_path)
+    shutil.rmtree(vault_path)
+    return files, timings
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            cwd=Path(__file__).parent, text=True, capture_output=True, check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def load_history(history_path):
+    if not history_path.is_file():
+        return []
+    with open(history_path, encoding='utf-8') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def main():
+    """
+    主函数，生成合成库并对附件整理的各个阶段计时。
+    """
+    parser = argparse.ArgumentParser(
+        description="生成可复现的合成 Obsidian 库，对附件整理脚本的各个阶段计时。",
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument("--notes", type=int, default=200, help="笔记数量。默认为: 200。")
+    parser.add_argument("--attachments", type=int, default=400, help="附件数量。默认为: 400。")
+    parser.add_argument("--links-per-note", type=int, default=5, help="每篇笔记平均的附件链接数。默认为: 5。")
+    parser.add_argument("--duplicate-ratio", type=float, default=0.1, help="与其他附件同名的附件比例。默认为: 0.1。")
+    parser.add_argument("--depth", type=int, default=3, help="文件夹最大嵌套深度。默认为: 3。")
+    parser.add_argument("--seed", type=int, default=0, help="随机种子。默认为: 0。")
+    parser.add_argument(
+        "--scales",
+        type=str,
+        default="1",
+        help="以逗号分隔的规模倍数，例如 '1,2,4'。\n"
+             "笔记数和附件数会按倍数放大，用于观察耗时随规模的增长。"
+    )
+    parser.add_argument(
+        "--history",
+        type=str,
+        default="bench_history.jsonl",
+        help="记录历次结果的文件，用于跨版本比较。默认为: 'bench_history.jsonl'。"
+    )
+    args = parser.parse_args()
+
+    scales = [float(s) for s in args.scales.split(",")]
+    history_path = Path(args.history)
+    history = load_history(history_path)
+    revision = git_revision()
+    print(f"📊 当前版本: {revision}")
+
+    stages = ["index", "resolve", "rewrite", "organize"]
+    previous = None
+    with tempfile.TemporaryDirectory() as tmp:
+        for scale in scales:
+            params = {
+                "notes": round(args.notes * scale),
+                "attachments": round(args.attachments * scale),
+                "links_per_note": args.links_per_note,
+                "duplicate_ratio": args.duplicate_ratio,
+                "depth": args.depth,
+                "seed": args.seed,
+            }
+            files, timings = run_benchmark(Path(tmp), params)
+            print(f"\n📁 规模 x{scale:g}: {params['notes']} 篇笔记, {params['attachments']} 个附件, 共 {files} 个文件")
+            for stage in stages:
+                line = f"   {stage:<9} {timings[stage]:9.3f} s"
+                if previous is not None and previous[stage] > 0:
+                    line += f"   (上一规模的 {timings[stage] / previous[stage]:.1f} 倍)"
+                print(line)
+            previous = timings
+
+            # 与历史中参数相同、版本不同的最近一次结果比较
+            baseline = next(
+                (h for h in reversed(history) if h["params"] == params and h["revision"] != revision),
+                None,
+            )
+            if baseline:
+                print(f"   与版本 {baseline['revision']} 相比:")
+                for stage in stages:
+                    old = baseline["timings"].get(stage)
+                    if old:
+                        print(f"   {stage:<9} {old:9.3f} s -> {timings[stage]:9.3f} s ({old / max(timings[stage], 1e-9):.1f}x)")
+
+            record = {
+                "time": datetime.now().isoformat(timespec="seconds"),
+                "revision": revision,
+                "params": params,
+                "timings": timings,
+            }
+            history.append(record)
+            with open(history_path, "a", encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    print(f"\n💾 结果已追加到 {history_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,8 +2,21 @@
 import os
 import re
 import shutil
+import json
+import hashlib
 import argparse
+from urllib.parse import unquote
 from pathlib import Path
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+# 去重时用于快速比较的文件头部字节数
+DEDUP_PARTIAL_SIZE = 64 * 1024
+
+# 笔记中引用文件的写法：[[...]]、[](...) / [](<...>) 以及 HTML 的 src="..."
+WIKILINK_RE = re.compile(r'!*\[\[([^|\]#]+)')
+MARKDOWN_LINK_RE = re.compile(r'\]\(\s*(?:<([^>]+)>|([^)\s]+))')
+HTML_SRC_RE = re.compile(r'\bsrc\s*=\s*["\']([^"\']+)["\']', re.IGNORECASE)
 
 def find_file_in_vault(filename, vault_path):
     """
@@ -22,7 +35,220 @@ def find_file_in_vault(filename, vault_path):
             return Path(root) / filename
     return None
 
-def process_markdown_file(markdown_path, vault_path, attachments_folder="attachments"):
+def file_digest(path, limit=None, chunk_size=1024 * 1024):
+    """
+    Computes the BLAKE2b digest of a file.
+
+    Args:
+        path (Path): The file to hash.
+        limit (int or None): Only hash the first `limit` bytes if given.
+        chunk_size (int): The read buffer size.
+
+    Returns:
+        str: The hex digest.
+    """
+    h = hashlib.blake2b(digest_size=20)
+    remaining = limit
+    with open(path, 'rb') as f:
+        while remaining is None or remaining > 0:
+            size = chunk_size if remaining is None else min(chunk_size, remaining)
+            chunk = f.read(size)
+            if not chunk:
+                break
+            h.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return h.hexdigest()
+
+def find_duplicate_groups(paths, workers=None):
+    """
+    Groups files with identical content.
+
+    Candidates are narrowed by size first, then by a hash of the first
+    DEDUP_PARTIAL_SIZE bytes, and only then by a full hash. Hashing runs in a
+    thread pool.
+
+    Args:
+        paths (iterable of Path): The files to compare.
+        workers (int or None): The number of hashing threads.
+
+    Returns:
+        list of list of Path: Groups of two or more identical files, each
+        keeping the order in which the files were given.
+    """
+    by_size = defaultdict(list)
+    for path in dict.fromkeys(paths):
+        try:
+            by_size[path.stat().st_size].append(path)
+        except OSError as e:
+            print(f"⚠️  警告：无法读取文件信息 '{path}': {e}")
+    candidates = [(size, group) for size, group in by_size.items() if len(group) > 1]
+    if not candidates:
+        return []
+
+    def split_by_digest(groups, limit):
+        jobs = [path for _, group in groups for path in group]
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            digests = dict(zip(jobs, pool.map(lambda p: file_digest(p, limit), jobs)))
+        result = []
+        for size, group in groups:
+            by_digest = defaultdict(list)
+            for path in group:
+                by_digest[digests[path]].append(path)
+            result.extend((size, g) for g in by_digest.values() if len(g) > 1)
+        return result
+
+    candidates = split_by_digest(candidates, DEDUP_PARTIAL_SIZE)
+    # 小文件的部分哈希已经覆盖了全部内容，无需再计算完整哈希
+    confirmed = [group for size, group in candidates if size <= DEDUP_PARTIAL_SIZE]
+    large = [(size, group) for size, group in candidates if size > DEDUP_PARTIAL_SIZE]
+    if large:
+        confirmed.extend(group for _, group in split_by_digest(large, None))
+    return confirmed
+
+def link_targets(text):
+    """
+    Extracts the file names referenced from Markdown text.
+
+    Covers wikilinks, Markdown links (URL-encoded or in angle brackets) and
+    HTML src attributes.
+
+    Returns:
+        list of str: The referenced file names, without folders.
+    """
+    targets = [link.strip() for link in WIKILINK_RE.findall(text)]
+    for bracketed, bare in MARKDOWN_LINK_RE.findall(text):
+        targets.append(unquote(bracketed or bare).split('#')[0].split('?')[0])
+    targets.extend(unquote(src).split('#')[0].split('?')[0] for src in HTML_SRC_RE.findall(text))
+    return [os.path.basename(t.replace('\\', '/')) for t in targets if t]
+
+def canvas_link_targets(text):
+    """
+    Extracts the file names referenced from a .canvas file: file nodes and
+    links inside text nodes.
+    """
+    targets = []
+    for node in json.loads(text).get('nodes', []):
+        if node.get('type') == 'file' and node.get('file'):
+            targets.append(os.path.basename(node['file']))
+        elif node.get('type') == 'text':
+            targets.extend(link_targets(node.get('text', '')))
+    return targets
+
+def find_referenced_names(names, vault_path):
+    """
+    Finds which of the given attachment names are referenced from notes or canvases.
+
+    A file that cannot be read or parsed might reference any of them, so in that
+    case every name counts as referenced.
+
+    Args:
+        names (iterable of str): The attachment file names to look for.
+        vault_path (Path): The root path of the Obsidian vault.
+
+    Returns:
+        set of str: The names referenced from at least one file.
+    """
+    wanted = {os.path.normcase(n): n for n in names}
+    referenced = set()
+    for root, _, files in os.walk(vault_path):
+        for f in files:
+            suffix = os.path.splitext(f)[1].lower()
+            if suffix not in ('.md', '.canvas'):
+                continue
+            path = Path(root) / f
+            try:
+                text = path.read_text(encoding='utf-8')
+                targets = canvas_link_targets(text) if suffix == '.canvas' else link_targets(text)
+            except Exception as e:
+                print(f"⚠️  无法读取 '{path}' ({e})，保留所有重复文件。")
+                return set(wanted.values())
+            for target in targets:
+                key = os.path.normcase(target)
+                if key in wanted:
+                    referenced.add(wanted[key])
+    return referenced
+
+def dedup_linked_attachments(content, link_names, vault_path, dest_dir,
+                             attachments_folder="attachments", workers=None):
+    """
+    Collapses identical attachments linked from a Markdown file into one file.
+
+    Links to duplicates are repointed to the kept file. The duplicates are only
+    returned here; delete them with remove_redundant_attachments once the
+    updated content has been saved.
+
+    Args:
+        content (str): The Markdown file content.
+        link_names (iterable of str): The link targets found in the content.
+        vault_path (Path): The root path of the Obsidian vault.
+        dest_dir (Path): The attachments folder of the Markdown file.
+        attachments_folder (str): The attachments folder as written in links.
+        workers (int or None): The number of hashing threads.
+
+    Returns:
+        tuple: (updated content, list of duplicate files no longer linked)
+    """
+    sources = {}
+    for link_name in link_names:
+        link_name = link_name.strip()
+        source_path = find_file_in_vault(link_name, str(vault_path))
+        if source_path and source_path.is_file():
+            sources.setdefault(source_path, []).append(link_name)
+
+    # 附件文件夹中已有的文件也参与比较，优先保留它们
+    existing = sorted(p for p in dest_dir.iterdir() if p.is_file()) if dest_dir.is_dir() else []
+    groups = find_duplicate_groups(existing + list(sources), workers)
+    if not groups:
+        print("🔵 未发现内容重复的附件。")
+        return content, []
+
+    updated_content = content
+    redundant = []
+    for group in groups:
+        keep = next((p for p in group if p.parent == dest_dir), group[0])
+        target = f"{attachments_folder}/{keep.name}" if keep.parent == dest_dir else keep.name
+        for dup in group:
+            if dup == keep or dup not in sources:
+                continue
+            for link_name in sources[dup]:
+                pattern = re.compile(r'(!?\[\[)(' + re.escape(link_name) + r')(?=[|\]#])')
+                updated_content = pattern.sub(lambda m: m.group(1) + target, updated_content)
+            print(f"🔗 '{dup.name}' 与 '{keep.name}' 内容相同，已将链接指向后者。")
+            redundant.append(dup)
+    return updated_content, redundant
+
+def remove_redundant_attachments(redundant, vault_path):
+    """
+    Deletes duplicate attachments that nothing in the vault references any more.
+
+    Call this after the repointed note has been saved, so that links it still
+    has (e.g. Markdown links, which are not repointed) keep their files.
+
+    Args:
+        redundant (list of Path): The duplicates returned by dedup_linked_attachments.
+        vault_path (Path): The root path of the Obsidian vault.
+
+    Returns:
+        int: The number of bytes reclaimed.
+    """
+    still_used = find_referenced_names((p.name for p in redundant), vault_path)
+    reclaimed = 0
+    for dup in redundant:
+        if dup.name in still_used:
+            print(f"⚪️ 重复文件 '{dup}' 仍被笔记或白板引用，保留。")
+            continue
+        try:
+            size = dup.stat().st_size
+            dup.unlink()
+            reclaimed += size
+            print(f"🗑️  已删除重复文件: '{dup}'")
+        except Exception as e:
+            print(f"❌ 删除重复文件 '{dup}' 时出错: {e}")
+    return reclaimed
+
+def process_markdown_file(markdown_path, vault_path, attachments_folder="attachments",
+                          dedup=False, hash_workers=None):
     """
     Processes a single Markdown file to move its attachments and update links.
 
@@ -30,6 +256,8 @@ def process_markdown_file(markdown_path, vault_path, attachments_folder="attachm
         markdown_path (Path): The path to the Markdown file.
         vault_path (Path): The root path of the Obsidian vault.
         attachments_folder (str): The name of the folder to move attachments to.
+        dedup (bool): Collapse attachments with identical content before moving.
+        hash_workers (int or None): The number of threads used for hashing.
     """
     if not markdown_path.is_file():
         print(f"❌ 错误：文件不存在 -> {markdown_path}")
@@ -50,7 +278,7 @@ def process_markdown_file(markdown_path, vault_path, attachments_folder="attachm
 
     # 3. 查找所有 [[...]] 格式的链接中的文件名部分
     # 这个正则表达式可以正确提取文件名，无论链接是否带别名或指向标题
-    wikilinks = re.findall(r'!*\[\[([^|\]#]+)', content)
+    wikilinks = WIKILINK_RE.findall(content)
     
     if not wikilinks:
         print("🔵 未在该文件中找到符合条件的 [[...]] 链接。")
@@ -59,6 +287,15 @@ def process_markdown_file(markdown_path, vault_path, attachments_folder="attachm
     print(f"🔍 找到 {len(set(wikilinks))} 个唯一链接: {set(wikilinks)}")
 
     updated_content = content
+    redundant = []
+    reclaimed_bytes = 0
+    if dedup:
+        print("🧮 正在检查内容重复的附件...")
+        updated_content, redundant = dedup_linked_attachments(
+            content, set(wikilinks), vault_path, dest_dir, attachments_folder, hash_workers
+        )
+        wikilinks = WIKILINK_RE.findall(updated_content)
+
     files_moved_count = 0
     folder_created = False # 用于跟踪文件夹是否已创建的标志
 
@@ -114,17 +351,28 @@ def process_markdown_file(markdown_path, vault_path, attachments_folder="attachm
             print(f"❌ 移动文件 '{source_path}' 时出错: {e}")
 
     # 5. 将更新后的内容写回文件
-    if content != updated_content:
+    saved = content == updated_content
+    if not saved:
         try:
             markdown_path.write_text(updated_content, encoding='utf-8')
+            saved = True
             print(f"💾 成功将更新后的内容保存到 {markdown_path.name}")
         except Exception as e:
             print(f"❌ 保存文件 {markdown_path.name} 时出错: {e}")
+
+    # 6. 笔记保存成功后才删除重复文件，否则笔记会指向已删除的文件
+    if redundant:
+        if saved:
+            reclaimed_bytes = remove_redundant_attachments(redundant, vault_path)
+        else:
+            print("⚠️  笔记未能保存，保留所有重复文件。")
     
     if files_moved_count > 0:
         print(f"✨ 处理完成！共移动了 {files_moved_count} 个文件。")
     else:
         print("✨ 处理完成！没有文件被移动。")
+    if reclaimed_bytes > 0:
+        print(f"♻️  去重共释放了 {reclaimed_bytes / 1024 / 1024:.2f} MiB 空间。")
 
 
 def main():
@@ -154,6 +402,17 @@ def main():
              "这个文件夹将被创建在 Markdown 文件所在的目录中。\n"
              "默认为: 'attachments'。"
     )
+    parser.add_argument(
+        "--dedup",
+        action="store_true",
+        help="移动前按内容合并重复的附件，并将链接指向保留的文件。"
+    )
+    parser.add_argument(
+        "--hash-workers",
+        type=int,
+        default=None,
+        help="计算文件哈希时使用的线程数。默认由 Python 自动决定。"
+    )
 
     args = parser.parse_args()
 
@@ -164,7 +423,7 @@ def main():
         print(f"❌ 错误：指定的库路径不是一个有效的目录 -> {vault_path}")
         return
 
-    process_markdown_file(markdown_path, vault_path, args.dest)
+    process_markdown_file(markdown_path, vault_path, args.dest, args.dedup, args.hash_workers)
 
 if __name__ == "__main__":
     main()